@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import dpcm
+import looper
+import metrics
+import midi
+import repitcher
+import splitter
+import waveform
+
+# python stdlib
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import time
+
+tools = {
+    "looper": looper,
+    "repitcher": repitcher,
+    "splitter": splitter,
+}
+
+# Each worker process keeps whatever it has already built, so jobs which land on
+# the same worker and share a rate or a source file don't pay for it twice
+# (run_jobs makes sure they do land together).
+_tuning_tables = {}
+_sources = {}
+_wave_generators = {}
+
+# Tables only hold the notes asked of them so far; each job tops up the notes it
+# needs, and the rest stay None.
+def build_tunings(playback_rate, max_length, notes):
+    key = (playback_rate, max_length)
+    table = _tuning_tables.setdefault(key, [None] * 94)
+    missing = sorted(set(note for note in notes if table[note] == None))
+    if missing:
+        built = looper.generate_tuning_table(dpcm.playback_rate[playback_rate], max_length, missing)
+        for note in missing:
+            table[note] = built[note]
+    return table
+
+def shared_tuning_table(args):
+    return build_tunings(args.playback_rate, args.max_length, midi.parse_note_list(args.notes))
+
+def shared_source(module, filename):
+    # keyed on the file's size and modification time too, so an edited source is read again
+    status = os.stat(filename)
+    key = (os.path.abspath(filename), status.st_size, status.st_mtime_ns)
+    if key not in _sources:
+        _sources[key] = module.read_wave(filename)
+    return _sources[key]
+
+def shared_wave_generator(filename):
+    # the looper's -w waveform, keyed like shared_source
+    status = os.stat(filename)
+    key = (os.path.abspath(filename), status.st_size, status.st_mtime_ns)
+    if key not in _wave_generators:
+        _wave_generators[key] = waveform.wave_file(filename)
+    return _wave_generators[key]
+
+def share_key(job):
+    args = job["args"]
+    if job["tool"] == "looper":
+        return ("tuning", args.playback_rate, args.max_length)
+    return ("source", os.path.abspath(args.source))
+
+def read_manifest(filename):
+    if filename.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise Exception("TOML manifests need Python 3.11 or newer, use JSON instead")
+        with io.open(filename, "rb") as manifest_file:
+            manifest = tomllib.load(manifest_file)
+    else:
+        with io.open(filename, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    jobs = []
+    for index, entry in enumerate(manifest.get("jobs", [])):
+        tool = entry.get("tool")
+        if tool not in tools:
+            raise Exception("Job {}: unknown tool {!r}, expected one of: {}".format(index + 1, tool, ", ".join(tools.keys())))
+        argv = [str(x) for x in entry.get("args", [])]
+        try:
+            args = tools[tool].build_parser().parse_args(argv)
+        except SystemExit:
+            raise Exception("Job {}: invalid arguments for {}: {}".format(index + 1, tool, " ".join(argv)))
+        name = entry.get("name") or "{}-{}".format(tool, index + 1)
+        jobs.append({"index": index, "name": name, "tool": tool, "args": args})
+    return jobs
+
+# Every file (or, for the splitter's numbered chunks, every filename pattern) a
+# job is going to write. Two jobs may share a directory, but not a claim.
+def output_claims(job):
+    runs = [job["args"]]
+    if job["tool"] == "looper":
+        # a looper sweep writes every variant under its own label
+        runs = [looper.variant_args(job["args"], variant) for variant in looper.sweep_variants(job["args"])]
+    claims = []
+    for args in runs:
+        if args.instrument:
+            claims.append(os.path.abspath(args.instrument))
+        if args.archive:
+            claims.append(os.path.abspath(args.archive))
+        directory = getattr(args, "directory", None)
+        if directory:
+            if job["tool"] == "splitter":
+                claims.append(os.path.abspath(os.path.join(directory, "thing_*.dmc")))
+            else:
+                prefix = tools[job["tool"]].sample_prefix(args)
+                sample_prefix = ""
+                if prefix:
+                    sample_prefix = prefix + "-"
+                for note in midi.parse_note_list(args.notes):
+                    claims.append(os.path.abspath(os.path.join(directory, sample_prefix + midi.note_name(note)) + ".dmc"))
+    return claims
+
+def find_conflicts(jobs):
+    owners = {}
+    conflicts = []
+    for job in jobs:
+        for claim in output_claims(job):
+            if claim in owners and owners[claim] != job["name"]:
+                conflicts.append("{} is written by both {} and {}".format(claim, owners[claim], job["name"]))
+            owners[claim] = job["name"]
+    return conflicts
+
+# Runs one job with whatever this process has already built, and returns the
+# paths it wrote.
+def execute_job(job, stats=None):
+    module = tools[job["tool"]]
+    args = job["args"]
+    if args.instrument:
+        # the tools expect an instrument's directory to exist already
+        os.makedirs(os.path.dirname(os.path.abspath(args.instrument)), exist_ok=True)
+    if job["tool"] == "looper":
+        wave_generator = None
+        if "wave" in args.generator and args.wavefile:
+            wave_generator = shared_wave_generator(args.wavefile)
+        return module.run(args, tuning_table=shared_tuning_table(args), stats=stats, wave_generator=wave_generator)
+    return module.run(args, source=shared_source(module, args.source), stats=stats)
+
+def run_job(job, track_memory=False):
+    summary = {"index": job["index"], "name": job["name"], "tool": job["tool"], "status": "ok", "error": None, "outputs": [], "bytes": 0}
+    log = io.StringIO()
+    job_metrics = metrics.Metrics(track_memory=track_memory)
+    start_time = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            written_paths = execute_job(job, stats=job_metrics)
+        summary["outputs"] = written_paths
+        summary["bytes"] = sum(os.path.getsize(path) for path in written_paths)
+    except SystemExit as e:
+        summary["status"] = "failed"
+        summary["error"] = str(e.code)
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "{}: {}".format(type(e).__name__, e)
+    summary["seconds"] = time.perf_counter() - start_time
+    job_metrics.close()
+    summary["metrics"] = job_metrics.report()
+    summary["log"] = log.getvalue()
+    return summary
+
+def format_summary(summary):
+    line = "[{}] {} ({}): {} files, {} bytes, {:.2f}s".format(
+        summary["status"], summary["name"], summary["tool"], len(summary["outputs"]), summary["bytes"], summary["seconds"])
+    if summary["error"]:
+        line += "\n    " + summary["error"]
+    return line
+
+# A pool has no worker affinity, so a table or source cached by one worker is no
+# use to a job which lands on another. Tuning tables are small and quick to share
+# out: every worker builds the notes the manifest's looper jobs ask for before
+# it takes any jobs (see prepare_worker), so looper jobs go out one at a time. Jobs which share a
+# source file are handed to a worker together, as one task, and read it once
+# between them; large groups are cut into pieces so every worker still gets some.
+def job_batches(jobs, workers):
+    batch_size = max(1, -(-len(jobs) // max(workers, 1)))
+    batches = []
+    groups = {}
+    for job in sorted(jobs, key=lambda job: job["index"]):
+        if job["tool"] == "looper":
+            batches.append([job])
+        else:
+            groups.setdefault(share_key(job), []).append(job)
+    for group in groups.values():
+        for i in range(0, len(group), batch_size):
+            batches.append(group[i:i + batch_size])
+    return batches
+
+# The notes the manifest's looper jobs ask for, by playback rate and length.
+def tuning_notes(jobs):
+    notes = {}
+    for job in jobs:
+        if job["tool"] == "looper":
+            key = (job["args"].playback_rate, job["args"].max_length)
+            # a note out of range fails its own job, not every worker's start
+            notes.setdefault(key, set()).update(note for note in midi.parse_note_list(job["args"].notes) if 0 <= note < 94)
+    return notes
+
+# Runs in each worker process as it starts.
+def prepare_worker(notes):
+    for (playback_rate, max_length), key_notes in notes.items():
+        build_tunings(playback_rate, max_length, key_notes)
+
+def run_job_batch(batch, track_memory=False):
+    return [run_job(job, track_memory) for job in batch]
+
+# Runs every job, on a pool of worker processes when workers > 1, and returns
+# their summaries in manifest order.
+def run_jobs(jobs, workers=1, verbose=False, track_memory=False):
+    summaries = []
+    def report(summary):
+        print(format_summary(summary))
+        if verbose and summary["log"]:
+            print(summary["log"].rstrip())
+        summaries.append(summary)
+    if workers <= 1:
+        for job in sorted(jobs, key=lambda job: (share_key(job), job["index"])):
+            report(run_job(job, track_memory))
+    else:
+        notes = tuning_notes(jobs)
+        initializer = None
+        initargs = ()
+        if notes:
+            initializer = prepare_worker
+            initargs = (notes,)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            futures = [executor.submit(run_job_batch, batch, track_memory) for batch in job_batches(jobs, workers)]
+            for future in concurrent.futures.as_completed(futures):
+                for summary in future.result():
+                    report(summary)
+    summaries.sort(key=lambda summary: summary["index"])
+    return summaries
+
+def main(argv=None):
+    examples = """
+    Manifest (JSON):
+      {"jobs": [
+        {"name": "saw", "tool": "looper", "args": ["-g", "sawtooth", "-i", "out/saw.fti", "as2-d3"]},
+        {"tool": "repitcher", "args": ["piano.wav", "c4-c5", "-i", "out/piano.fti"]},
+        {"tool": "splitter", "args": ["song.wav", "0.5", "-s", "out/song"]}
+      ]}
+
+    TOML manifests (Python 3.11+) use the same fields, as [[jobs]] tables.
+    Paths are relative to the current directory.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build many instruments from one manifest, sharing work between them",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=examples)
+    parser.add_argument("manifest", help="Path to a .json or .toml manifest of jobs")
+    parser.add_argument("-j", "--jobs", help="Number of worker processes (default: one per CPU)", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--verbose", help="Show each job's own output, and the time spent in each stage", action='store_true')
+    parser.add_argument("--stats-json", dest="stats_json", help="Write per-job and combined stage reports, with peak memory, to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = read_manifest(args.manifest)
+    except Exception as e:
+        exit("Error: {}".format(e))
+    conflicts = find_conflicts(jobs)
+    if conflicts:
+        exit("Error: jobs would overwrite each other's output:\n  " + "\n  ".join(conflicts))
+
+    start_time = time.perf_counter()
+    summaries = run_jobs(jobs, workers=min(args.jobs, len(jobs)), verbose=args.verbose, track_memory=bool(args.stats_json))
+    elapsed = time.perf_counter() - start_time
+    failed = [summary for summary in summaries if summary["status"] != "ok"]
+    print("{} jobs, {} failed, {} files, {} bytes in {:.2f}s".format(
+        len(summaries), len(failed),
+        sum(len(summary["outputs"]) for summary in summaries),
+        sum(summary["bytes"] for summary in summaries),
+        elapsed))
+    combined = metrics.merge_reports([summary["metrics"] for summary in summaries])
+    if args.verbose:
+        print(metrics.format_report(combined, notes=False))
+    if args.stats_json:
+        output = io.open(args.stats_json, "w")
+        json.dump({
+            "jobs": dict((summary["name"], summary["metrics"]) for summary in summaries),
+            "combined": combined,
+        }, output, indent=2)
+        output.close()
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
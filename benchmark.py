@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# Times the hot paths of every tool against synthesised, deterministic inputs,
+# and compares the results with a saved JSON baseline. Runs offline, with
+# nothing but the standard library.
+
+import dpcm
+import fti
+import looper
+import midi
+import repitcher
+import splitter
+import waveform
+
+# python stdlib
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+BENCHMARK_VERSION = 1
+SOURCE_RATE = 44100
+FULL_RANGE = list(range(0, 94)) # every note the looper's tuning table covers
+
+# A few detuned sines plus a little noise from a fixed LCG, so every run (on every
+# machine) encodes exactly the same audio.
+def synthesize_pcm(seconds, samplerate=SOURCE_RATE):
+    frames = []
+    noise = 12345
+    for i in range(0, int(seconds * samplerate)):
+        t = i / samplerate
+        noise = (noise * 1103515245 + 12345) & 0x7FFFFFFF
+        sample = 0.4 * math.sin(2 * math.pi * 220.0 * t)
+        sample += 0.2 * math.sin(2 * math.pi * 331.0 * t)
+        sample += 0.1 * math.sin(2 * math.pi * 1487.0 * t)
+        sample += 0.05 * (noise / 0x7FFFFFFF - 0.5)
+        frames.append(int(sample * 32767))
+    return frames
+
+def write_source(filename, frames, samplerate=SOURCE_RATE):
+    writer = wave.open(filename, mode="wb")
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(samplerate)
+    writer.writeframes(struct.pack("<{}h".format(len(frames)), *frames))
+    writer.close()
+
+def quietly(function):
+    def quiet_function():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function()
+    return quiet_function
+
+# prepare builds the case's input and returns (units, run); it is only called
+# for cases that are selected, so filtered out cases cost nothing.
+def case(name, unit_name, prepare, track_memory=True):
+    return {"name": name, "unit_name": unit_name, "prepare": prepare, "track_memory": track_memory}
+
+# Calls function once, on first use, and hands every later caller the same result.
+def once(function):
+    results = []
+    def cached():
+        if not results:
+            results.append(function())
+        return results[0]
+    return cached
+
+# Lists every case. Inputs are only prepared when a case is about to run, and
+# outside its timer, so only the stage being measured is timed.
+def build_cases(durations, directory):
+    cases = []
+    rate = dpcm.playback_rate[0xF]
+    split_length = math.floor(0.25 * rate / 8)
+    chunk_length = (math.floor(split_length / 16) + 5) * 16 + 1
+
+    def source(seconds):
+        source_filename = os.path.join(directory, "source-{}s.wav".format(seconds))
+        write_source(source_filename, synthesize_pcm(seconds))
+        data, samplerate = splitter.read_wave(source_filename)
+        return {"filename": source_filename, "data": data, "samplerate": samplerate}
+
+    sources = dict((seconds, once(lambda seconds=seconds: source(seconds))) for seconds in durations)
+    for seconds in durations:
+        label = "{}s".format(seconds)
+        inputs = sources[seconds]
+        encoded = once(lambda inputs=inputs: dpcm.to_dpcm(inputs()["data"]))
+        cases.append(case("ingest/" + label, "frames",
+            lambda inputs=inputs: (len(inputs()["data"]), lambda: splitter.read_wave(inputs()["filename"]))))
+        cases.append(case("to_dpcm/" + label, "samples",
+            lambda inputs=inputs: (len(inputs()["data"]), lambda data=inputs()["data"]: dpcm.to_dpcm(data))))
+        cases.append(case("split_chunks/" + label, "bytes",
+            lambda encoded=encoded: (len(encoded()), lambda dpcm_bytes=encoded(): splitter.split_chunks(dpcm_bytes, split_length, chunk_length))))
+        cases.append(case("bias/" + label, "bits",
+            lambda encoded=encoded: (len(encoded()) * 8, lambda dpcm_bytes=encoded(): dpcm.bias(dpcm_bytes))))
+
+    # bias counts set bits a byte at a time, so it is linear in its input; it is
+    # also measured at the sizes the looper hands it, from one looped note up to
+    # the longest possible sample, where the per-call overhead shows
+    for length in [dpcm.patch_bytes(16), dpcm.patch_bytes(255)]:
+        def prepare_bias(length=length):
+            dpcm_bytes = dpcm.to_dpcm(synthesize_pcm(length * 8 / SOURCE_RATE))[0:length]
+            return (len(dpcm_bytes) * 8, lambda: dpcm.bias(dpcm_bytes))
+        cases.append(case("bias/{}B".format(length), "bits", prepare_bias))
+
+    cases.append(case("tuning_table/$F", "tunings",
+        lambda: (94 * 254, lambda: looper.generate_tuning_table(rate, 255))))
+
+    tuning_table = once(lambda: looper.generate_tuning_table(rate, 255))
+    first_source = sources[durations[0]]
+    source_frequency = midi.frequency[midi.note_index("C4")]
+    for label, notes in [("1-note", [midi.note_index("C4")]), ("full-range", FULL_RANGE)]:
+        def prepare_resample(notes=notes):
+            source_data = first_source()["data"]
+            source_rate = first_source()["samplerate"]
+            def resample():
+                for note in notes:
+                    repitcher.resample_note(source_data, source_rate, rate, source_frequency, midi.frequency[note])
+            output_samples = sum(int(len(source_data) / ((source_rate / rate) * (midi.frequency[note] / source_frequency))) for note in notes)
+            return (output_samples, resample)
+        cases.append(case("resample_note/" + label, "samples", prepare_resample))
+
+        def generator(notes=notes):
+            table = tuning_table()
+            return quietly(lambda: looper.generate_samples(waveform.sine, notes, quiet=True, tuning_table=table))
+        cases.append(case("looper_notes/" + label, "notes",
+            lambda notes=notes, generator=generator: (len(notes), generator())))
+
+        def prepare_write(generator=generator):
+            sample_table, note_mappings = generator()()
+            note_mappings = fti.fill_lower_samples(note_mappings)
+            instrument_size = len(write_instrument(sample_table, note_mappings))
+            return (instrument_size, lambda: write_instrument(sample_table, note_mappings))
+        cases.append(case("write_instrument/" + label, "bytes", prepare_write))
+
+    # cold starts, each in a fresh interpreter, the way a shell script runs the
+    # tools; a bare interpreter is timed too, as what the targets are measured
+    # from. tracemalloc would only see this process, not the child, so their
+    # memory isn't tracked.
+    tool_directory = os.path.dirname(os.path.abspath(__file__))
+    cases.append(case("startup/python", "runs",
+        lambda: (1, lambda: subprocess.run([sys.executable, "-c", "pass"], stdout=subprocess.DEVNULL, check=True)),
+        track_memory=False))
+    for label, tool_args in [
+        ("looper-help", ["looper.py", "--help"]),
+        ("looper-1-note", ["looper.py", "-g", "sine", "-i", os.path.join(directory, "startup.fti"), "c4"]),
+        ("repitcher-help", ["repitcher.py", "--help"]),
+        ("splitter-help", ["splitter.py", "--help"])]:
+        command = [sys.executable, os.path.join(tool_directory, tool_args[0])] + tool_args[1:]
+        cases.append(case("startup/" + label, "runs",
+            lambda command=command: (1, lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True)),
+            track_memory=False))
+    return cases
+
+def write_instrument(sample_table, note_mappings):
+    output = io.BytesIO()
+    fti.write_dpcm_instrument(output, "DPCM benchmark", note_mappings, sample_table)
+    return output.getvalue()
+
+def measure(benchmark, repeat, track_memory):
+    (units, run) = benchmark["prepare"]()
+    timings = []
+    for i in range(0, repeat):
+        start_time = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start_time)
+    seconds = min(timings)
+    result = {
+        "seconds": seconds,
+        "units": units,
+        "unit_name": benchmark["unit_name"],
+        "units_per_second": units / max(seconds, 1e-9),
+        "peak_bytes": None,
+    }
+    # tracemalloc slows everything down, so memory gets a run of its own
+    if track_memory and benchmark["track_memory"]:
+        tracemalloc.start()
+        run()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_bytes"] = peak
+    return result
+
+# A case regresses when its throughput falls, or its peak memory grows, by more
+# than threshold (a fraction) compared with the baseline.
+def regressions(results, baseline, threshold):
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result["units_per_second"] < before["units_per_second"] * (1.0 - threshold):
+            found.append("{}: {:.0f} {}/s, baseline {:.0f}".format(
+                name, result["units_per_second"], result["unit_name"], before["units_per_second"]))
+        if result["peak_bytes"] and before.get("peak_bytes") and result["peak_bytes"] > before["peak_bytes"] * (1.0 + threshold):
+            found.append("{}: peak {} bytes, baseline {}".format(name, result["peak_bytes"], before["peak_bytes"]))
+    return found
+
+# Tools whose cold start adds more than target seconds to the bare interpreter's.
+# Needs startup/python among the results.
+def startup_overruns(results, target):
+    found = []
+    if "startup/python" not in results:
+        return found
+    bare = results["startup/python"]["seconds"]
+    for name, result in results.items():
+        if name.startswith("startup/") and name != "startup/python" and result["seconds"] - bare > target:
+            found.append("{}: {:.0f} ms over a bare interpreter, target {:.0f} ms".format(
+                name, (result["seconds"] - bare) * 1000, target * 1000))
+    return found
+
+def format_result(name, result, before=None):
+    line = "{:<28} {:>10.4f}s {:>14.0f} {}/s".format(name, result["seconds"], result["units_per_second"], result["unit_name"])
+    if result["peak_bytes"] != None:
+        line += "  peak {:>8.1f} MiB".format(result["peak_bytes"] / (1024 * 1024))
+    if before:
+        line += "  ({:+.1f}%)".format((result["units_per_second"] / before["units_per_second"] - 1.0) * 100)
+    return line
+
+def main(argv=None):
+    examples = """
+    Examples:
+      Record a baseline:
+        %(prog)s -o baseline.json
+
+      Check a change against it, failing on a 20%% slowdown:
+        %(prog)s -b baseline.json -t 0.2
+
+      Only the cold start of each tool, failing past 50 ms over a bare interpreter:
+        %(prog)s -k startup --startup-target 0.05
+
+      Include an hour long source (slow, and needs several GB of memory):
+        %(prog)s --durations 1,60,3600
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the DPCM tools' hot paths on synthesised inputs",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=examples)
+    parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="Compare against results saved with -o")
+    parser.add_argument("-t", "--threshold", help="Allowed slowdown (or memory growth) against the baseline, as a fraction (default: 0.25)", type=float, default=0.25)
+    parser.add_argument("--durations", help="Source lengths in seconds, comma separated (default: 1,10,60)", default="1,10,60")
+    parser.add_argument("-r", "--repeat", help="Time each case this many times and keep the best (default: 3)", type=int, default=3)
+    parser.add_argument("-k", "--only", help="Only run cases whose name contains this")
+    parser.add_argument("--startup-target", dest="startup_target", help="Fail if a tool's cold start adds more than this many seconds to a bare interpreter's (default: no check)", type=float)
+    parser.add_argument("--no-memory", dest="memory", help="Skip the tracemalloc run for peak memory", action='store_false')
+    args = parser.parse_args(argv)
+
+    durations = [float(x) if "." in x else int(x) for x in args.durations.split(",")]
+    baseline = {}
+    if args.baseline:
+        with io.open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)["cases"]
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="dpcm-benchmark-") as directory:
+        for benchmark in build_cases(durations, directory):
+            if args.only and args.only not in benchmark["name"]:
+                continue
+            result = measure(benchmark, args.repeat, args.memory)
+            results[benchmark["name"]] = result
+            print(format_result(benchmark["name"], result, baseline.get(benchmark["name"])))
+
+    if args.output:
+        with io.open(args.output, "w") as output:
+            json.dump({
+                "version": BENCHMARK_VERSION,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cases": results,
+            }, output, indent=2)
+
+    found = regressions(results, baseline, args.threshold)
+    overruns = []
+    if args.startup_target != None:
+        overruns = startup_overruns(results, args.startup_target)
+    if found or overruns:
+        messages = []
+        if found:
+            messages.append("Regressions beyond {:.0f}%:\n  {}".format(args.threshold * 100, "\n  ".join(found)))
+        if overruns:
+            messages.append("Cold starts beyond {:.0f} ms:\n  {}".format(args.startup_target * 1000, "\n  ".join(overruns)))
+        exit("\n".join(messages))
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
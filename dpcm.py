@@ -1,6 +1,8 @@
-import midi
+import argparse
 import math
 import collections
+import operator
+import time
 
 # note: sensible indexes here range from 0-255
 def patch_bytes(length_index):
@@ -77,85 +79,397 @@ def to_dpcm(pcm_samples, starting_level=None):
       current_dpcm_level -= 2
   return pack_dpcm_bits_into_bytes(dpcm_bits)
 
+# The greedy encoder of to_dpcm, fed a block of PCM at a time: from a wave
+# reader, a resampler or a socket. The level and any bits short of a whole byte
+# carry over between calls, so the bytes of every encode() followed by flush()
+# are exactly those to_dpcm returns for the whole stream at once. Like to_dpcm,
+# the level starts from the first sample unless a starting level is given.
+class StreamEncoder:
+  def __init__(self, starting_level=None):
+    # the encoder's own (unclamped) level, None until the first sample
+    self.level = starting_level
+    self.partial_byte = 0
+    self.partial_bits = 0
+
+  # Encodes one block, returning every byte completed so far.
+  def encode(self, pcm_samples):
+    if self.level == None:
+      if len(pcm_samples) == 0:
+        return b""
+      self.level = dpcm_level(pcm_samples[0])
+    current_dpcm_level = self.level
+    byte_value = self.partial_byte
+    bit_index = self.partial_bits
+    byte_array = bytearray()
+    for target_level in map(dpcm_level, pcm_samples):
+      if target_level > current_dpcm_level:
+        byte_value |= 1 << bit_index
+        current_dpcm_level += 2
+      else:
+        current_dpcm_level -= 2
+      bit_index += 1
+      if bit_index == 8:
+        byte_array.append(byte_value)
+        byte_value = 0
+        bit_index = 0
+    self.level = current_dpcm_level
+    self.partial_byte = byte_value
+    self.partial_bits = bit_index
+    return bytes(byte_array)
+
+  # Pads out the last byte the way pack_dpcm_bits_into_bytes does, and returns
+  # it (or nothing, if the stream ended on a byte boundary).
+  def flush(self):
+    if self.partial_bits == 0:
+      return b""
+    byte_value = self.partial_byte
+    for bit_index in range(self.partial_bits, 8):
+      byte_value |= (bit_index % 2) << bit_index
+    self.partial_byte = 0
+    self.partial_bits = 0
+    return bytes([byte_value])
+
 def bias(dpcm_bytes):
-  bit_array = unpack_bytes_into_bits(list(dpcm_bytes))
-  current_dpcm_level = 0 # signed, also we don't care about range for this
-  while len(bit_array) > 0:
-    sample = bit_array.pop(0)
-    if sample == 1:
-      current_dpcm_level += 2
+  # every 1 bit is +2 and every 0 bit is -2, so only the count of 1s matters
+  # (signed, also we don't care about range for this)
+  ones = sum(bin(byte_value).count("1") for byte_value in dpcm_bytes)
+  return 2 * ones - 2 * (len(dpcm_bytes) * 8 - ones)
+
+# The 2A03 delta counter is 7 bits wide. A 1 bit adds 2 unless the counter is
+# above 125, a 0 bit subtracts 2 unless the counter is below 2; in both cases
+# the counter simply holds its value.
+def clamp_level(level):
+  return int(max(0, min(127, round(level))))
+
+def decode_levels(dpcm_bytes, starting_level=0):
+  current_level = clamp_level(starting_level)
+  levels = []
+  for byte_value in dpcm_bytes:
+    for i in range(0,8):
+      if (byte_value >> i) & 1:
+        if current_level <= 125:
+          current_level += 2
+      else:
+        if current_level >= 2:
+          current_level -= 2
+      levels.append(current_level)
+  return levels
+
+# mean squared error, in DPCM levels, of the hardware playback of dpcm_bytes
+# against the PCM it was encoded from. Padding bits are not counted.
+def encoding_error(pcm_samples, dpcm_bytes, starting_level=None):
+  if len(pcm_samples) == 0:
+    return 0.0
+  if starting_level == None:
+    starting_level = dpcm_level(pcm_samples[0])
+  levels = decode_levels(dpcm_bytes, starting_level)
+  total_error = 0.0
+  for target_level, actual_level in zip(map(dpcm_level, pcm_samples), levels):
+    total_error += (target_level - actual_level) ** 2
+  return total_error / len(pcm_samples)
+
+# Runs the trellis over pcm_samples, starting from a single known level, and
+# returns the bits of the path with the least total squared error. States are
+# the 64 counter values which share the starting level's parity; no other
+# value is reachable with steps of 2.
+def _trellis_path(target_levels, starting_level):
+  parity = starting_level % 2
+  state_levels = list(range(parity, 128, 2))
+  state_count = len(state_levels)
+  inf = float("inf")
+  cost = [inf] * state_count
+  cost[starting_level // 2] = 0.0
+  # (level - target)^2 without the target^2 term, which is the same for every
+  # state and so never changes which path wins
+  squared_levels = [level * level for level in state_levels]
+  decisions = []
+  for target_level in target_levels:
+    twice_target = 2.0 * target_level
+    # arriving with a 1 bit comes from the state below, with a 0 bit from the state above
+    from_below = [inf] + cost[:-1]
+    from_above = cost[1:] + [inf]
+    # the counter holds at the edges, so the end states can also arrive from themselves
+    top_holds = cost[-1] < from_below[-1]
+    bottom_holds = cost[0] <= from_above[0]
+    if top_holds:
+      from_below[-1] = cost[-1]
+    if bottom_holds:
+      from_above[0] = cost[0]
+    bits = bytes(map(operator.lt, from_below, from_above))
+    cost = [(below if below < above else above) + squared - twice_target * level
+      for below, above, squared, level in zip(from_below, from_above, squared_levels, state_levels)]
+    decisions.append((bits, top_holds, bottom_holds))
+  # trace the cheapest final state back to the start
+  state = cost.index(min(cost))
+  path = [0] * len(decisions)
+  for i in range(len(decisions) - 1, -1, -1):
+    bits, top_holds, bottom_holds = decisions[i]
+    bit = bits[state]
+    path[i] = bit
+    if bit == 1:
+      if not (state == state_count - 1 and top_holds):
+        state -= 1
     else:
-      current_dpcm_level -= 2
-  return current_dpcm_level
-
-
-playback_rate = [None] * 16
-playback_rate[0x0] = 4181.71
-playback_rate[0x1] = 4709.93
-playback_rate[0x2] = 5264.04
-playback_rate[0x3] = 5593.04
-playback_rate[0x4] = 6257.95
-playback_rate[0x5] = 7046.35
-playback_rate[0x6] = 7919.35
-playback_rate[0x7] = 8363.42
-playback_rate[0x8] = 9419.86
-playback_rate[0x9] = 11186.1
-playback_rate[0xA] = 12604.0
-playback_rate[0xB] = 13982.6
-playback_rate[0xC] = 16884.6
-playback_rate[0xD] = 21306.8
-playback_rate[0xE] = 24858.0
-playback_rate[0xF] = 33143.9
-
-ntsc_equivalency = [None] * 16
-ntsc_equivalency[0xE] = midi.note_index("C4") - midi.note_index("G3")
-ntsc_equivalency[0xD] = midi.note_index("G3") - midi.note_index("E3")
-ntsc_equivalency[0xC] = midi.note_index("E3") - midi.note_index("C3")
-ntsc_equivalency[0xB] = midi.note_index("C3") - midi.note_index("A2")
-ntsc_equivalency[0xA] = midi.note_index("A2") - midi.note_index("G2")
-ntsc_equivalency[0x9] = midi.note_index("G2") - midi.note_index("F2")
-ntsc_equivalency[0x8] = midi.note_index("F2") - midi.note_index("D2")
-ntsc_equivalency[0x7] = midi.note_index("D2") - midi.note_index("C2")
-ntsc_equivalency[0x6] = midi.note_index("C2") - midi.note_index("B1")
-ntsc_equivalency[0x5] = midi.note_index("B1") - midi.note_index("A1")
-ntsc_equivalency[0x4] = midi.note_index("A1") - midi.note_index("G1")
-ntsc_equivalency[0x3] = midi.note_index("G1") - midi.note_index("F1")
-ntsc_equivalency[0x2] = midi.note_index("F1") - midi.note_index("E1")
-ntsc_equivalency[0x1] = midi.note_index("E1") - midi.note_index("D1")
-ntsc_equivalency[0x0] = midi.note_index("D1") - midi.note_index("C1")
-
-pal_safe_equivalency = [None] * 16
-pal_safe_equivalency[0xD] = midi.note_index("C4") - midi.note_index("E3")
-pal_safe_equivalency[0xC] = midi.note_index("E3") - midi.note_index("C3")
-pal_safe_equivalency[0xB] = midi.note_index("C3") - midi.note_index("A2")
-pal_safe_equivalency[0xA] = midi.note_index("A2") - midi.note_index("G2")
-pal_safe_equivalency[0x9] = midi.note_index("G2") - midi.note_index("F2")
-pal_safe_equivalency[0x8] = midi.note_index("F2") - midi.note_index("D2")
-pal_safe_equivalency[0x7] = midi.note_index("D2") - midi.note_index("C2")
-pal_safe_equivalency[0x6] = midi.note_index("C2") - midi.note_index("B1")
-pal_safe_equivalency[0x5] = midi.note_index("B1") - midi.note_index("A1")
-pal_safe_equivalency[0x3] = midi.note_index("A1") - midi.note_index("F1")
-pal_safe_equivalency[0x2] = midi.note_index("F1") - midi.note_index("E1")
-pal_safe_equivalency[0x1] = midi.note_index("E1") - midi.note_index("D1")
-pal_safe_equivalency[0x0] = midi.note_index("D1") - midi.note_index("C1")
+      if not (state == 0 and bottom_holds):
+        state += 1
+  return path
+
+# Like to_dpcm, but chooses every bit to minimise the total squared error over
+# the 128 hardware levels rather than greedily chasing the next sample. With a
+# lookahead, the trellis only ever spans that many samples: each window commits
+# its first half and the next window starts from where that half ended, which
+# bounds memory on very long inputs at the cost of roughly twice the work.
+def to_dpcm_trellis(pcm_samples, starting_level=None, lookahead=None):
+  if lookahead and lookahead < 0:
+    raise ValueError("lookahead must be 0 or more, got {}".format(lookahead))
+  if starting_level == None:
+    starting_level = dpcm_level(pcm_samples[0])
+  current_level = clamp_level(starting_level)
+  target_levels = list(map(dpcm_level, pcm_samples))
+  if not lookahead or lookahead >= len(target_levels):
+    return pack_dpcm_bits_into_bytes(_trellis_path(target_levels, current_level))
+  commit_length = max(1, lookahead // 2)
+  dpcm_bits = []
+  position = 0
+  while position < len(target_levels):
+    window = target_levels[position:position + lookahead]
+    path = _trellis_path(window, current_level)
+    if position + len(window) < len(target_levels):
+      path = path[0:commit_length]
+    for bit in path:
+      if bit == 1:
+        if current_level <= 125:
+          current_level += 2
+      else:
+        if current_level >= 2:
+          current_level -= 2
+    dpcm_bits.extend(path)
+    position += len(path)
+  return pack_dpcm_bits_into_bytes(dpcm_bits)
+
+encoder_names = ["greedy", "trellis"]
+
+# argparse type for --lookahead: a window in samples, 0 meaning the whole input
+def lookahead_length(text):
+  try:
+    lookahead = int(text)
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid int value: {!r}".format(text))
+  if lookahead < 0:
+    raise argparse.ArgumentTypeError("must be 0 or more, got {}".format(lookahead))
+  return lookahead
+
+# returns an encoder with the same call signature as to_dpcm
+def encoder(name, lookahead=None):
+  if name == "greedy":
+    return to_dpcm
+  if name == "trellis":
+    def trellis_encoder(pcm_samples, starting_level=None):
+      return to_dpcm_trellis(pcm_samples, starting_level=starting_level, lookahead=lookahead)
+    return trellis_encoder
+  raise Exception("Unknown encoder: {}".format(name))
+
+# Reports the error and throughput of an encoding the caller has already made,
+# taking seconds, against the greedy encoder on the same PCM. Only the greedy
+# encoder is run here.
+def compare_encoders(pcm_samples, dpcm_data, seconds, starting_level=None):
+  start_time = time.perf_counter()
+  greedy_data = to_dpcm(pcm_samples, starting_level=starting_level)
+  greedy_seconds = time.perf_counter() - start_time
+  results = {}
+  for name, data, elapsed in [("greedy", greedy_data, greedy_seconds), ("chosen", dpcm_data, seconds)]:
+    elapsed = max(elapsed, 1e-9)
+    results[name] = {
+      "error": encoding_error(pcm_samples, data, starting_level),
+      "seconds": elapsed,
+      "samples_per_second": len(pcm_samples) / elapsed,
+    }
+  return results
+
+def format_comparison(results):
+  greedy = results["greedy"]
+  chosen = results["chosen"]
+  return "MSE: {:.3f} (greedy {:.3f}), {:.0f} samples/s (greedy {:.0f})".format(
+    chosen["error"], greedy["error"], chosen["samples_per_second"], greedy["samples_per_second"])
+
+
+# Plays the greedy encoder forward from all 128 starting levels at once. Starts
+# whose encoder and hardware levels meet take identical steps from then on, so
+# they are merged, and the work quickly falls to a handful of paths. Returns
+# the position reached by then, and each path as (encoder level, hardware level,
+# starting levels).
+def _merged_greedy_paths(target_levels, length):
+  # (encoder level, hardware level) -> starting levels
+  groups = {}
+  for level in range(0, 128):
+    groups[(level, level)] = [level]
+  position = 0
+  while position < length and len(groups) > 4:
+    padding = position >= len(target_levels)
+    if not padding:
+      target_level = target_levels[position]
+    next_groups = {}
+    for (encoder_level, hardware_level), starts in groups.items():
+      if padding:
+        bit = position % 2
+      else:
+        bit = target_level > encoder_level
+      if bit:
+        encoder_level += 2
+        if hardware_level <= 125:
+          hardware_level += 2
+      else:
+        encoder_level -= 2
+        if hardware_level >= 2:
+          hardware_level -= 2
+      key = (encoder_level, hardware_level)
+      if key in next_groups:
+        next_groups[key] = next_groups[key] + starts
+      else:
+        next_groups[key] = starts
+    groups = next_groups
+    position += 1
+  return position, [(encoder_level, hardware_level, starts) for (encoder_level, hardware_level), starts in groups.items()]
+
+# Carries one greedy path on from position to the end of the padding. Returns
+# the hardware level it ends on, and the squared error of the samples it covered
+# (padding is not counted).
+def _finish_greedy_path(target_levels, position, length, encoder_level, hardware_level):
+  total_error = 0.0
+  for target_level in target_levels[position:]:
+    if target_level > encoder_level:
+      encoder_level += 2
+      if hardware_level <= 125:
+        hardware_level += 2
+    else:
+      encoder_level -= 2
+      if hardware_level >= 2:
+        hardware_level -= 2
+    difference = target_level - hardware_level
+    total_error += difference * difference
+  for padding_position in range(max(position, len(target_levels)), length):
+    if padding_position % 2:
+      if hardware_level <= 125:
+        hardware_level += 2
+    else:
+      if hardware_level >= 2:
+        hardware_level -= 2
+  return hardware_level, total_error
+
+# The squared error of the greedy encoding from one starting level, over the
+# samples before position.
+def _greedy_prefix_error(target_levels, position, starting_level):
+  encoder_level = starting_level
+  hardware_level = clamp_level(starting_level)
+  total_error = 0.0
+  for target_level in target_levels[0:position]:
+    if target_level > encoder_level:
+      encoder_level += 2
+      if hardware_level <= 125:
+        hardware_level += 2
+    else:
+      encoder_level -= 2
+      if hardware_level >= 2:
+        hardware_level -= 2
+    difference = target_level - hardware_level
+    total_error += difference * difference
+  return total_error
+
+def _loop_rank(candidate):
+  return (abs(candidate["drift"]), candidate["error"])
+
+# Picks the delta counter value, and the encoding, which give the loop the least
+# net drift per pass (a drift of 0 makes the seam exact, since every pass then
+# starts from the same level) and then the least error. Every starting level is
+# searched with the merged greedy paths. Error is only worked out for the starts
+# tied on drift: each adds its own steps before its path merged to the error
+# the path collected once on its way to the end. Only the winner is encoded. The
+# chosen encoder, if it isn't the greedy one, is then tried at the winning level.
+def best_loop_start(pcm_samples, chosen_encoder=to_dpcm):
+  target_levels = list(map(dpcm_level, pcm_samples))
+  length = len(target_levels) + (8 - len(target_levels) % 8) % 8
+  (position, paths) = _merged_greedy_paths(target_levels, length)
+  finished = []
+  for (encoder_level, hardware_level, starts) in paths:
+    (hardware_level, path_error) = _finish_greedy_path(target_levels, position, length, encoder_level, hardware_level)
+    finished.append((hardware_level, path_error, starts))
+  least_drift = min(abs(hardware_level - start) for (hardware_level, path_error, starts) in finished for start in starts)
+  candidates = []
+  for (hardware_level, path_error, starts) in finished:
+    for start in starts:
+      if abs(hardware_level - start) == least_drift:
+        candidates.append({
+          "delta": start,
+          "drift": hardware_level - start,
+          "error": (_greedy_prefix_error(target_levels, position, start) + path_error) / max(len(target_levels), 1),
+        })
+  best = min(sorted(candidates, key=lambda candidate: candidate["delta"]), key=_loop_rank)
+  best["data"] = to_dpcm(pcm_samples, starting_level=best["delta"])
+  if chosen_encoder != to_dpcm:
+    delta = best["delta"]
+    dpcm_data = chosen_encoder(pcm_samples, starting_level=delta)
+    levels = decode_levels(dpcm_data, delta)
+    best = min([best, {
+      "delta": delta,
+      "data": dpcm_data,
+      "drift": levels[-1] - delta,
+      "error": encoding_error(pcm_samples, dpcm_data, delta),
+    }], key=_loop_rank)
+  return best
+
+
+# Constant tables, indexed by DPCM rate $0-$F. Written out rather than worked out
+# at import, since every tool run loads them.
+playback_rate = [
+  4181.71, 4709.93, 5264.04, 5593.04, 6257.95, 7046.35, 7919.35, 8363.42,
+  9419.86, 11186.1, 12604.0, 13982.6, 16884.6, 21306.8, 24858.0, 33143.9,
+]
+
+# in semitones, the interval from each rate up to rate + $1
+ntsc_equivalency = [
+  2, # $0: D1 - C1
+  2, # $1: E1 - D1
+  1, # $2: F1 - E1
+  2, # $3: G1 - F1
+  2, # $4: A1 - G1
+  2, # $5: B1 - A1
+  1, # $6: C2 - B1
+  2, # $7: D2 - C2
+  3, # $8: F2 - D2
+  2, # $9: G2 - F2
+  2, # $A: A2 - G2
+  3, # $B: C3 - A2
+  4, # $C: E3 - C3
+  3, # $D: G3 - E3
+  5, # $E: C4 - G3
+  None,
+]
+
+# as above, skipping the rates which play out of tune on PAL
+pal_safe_equivalency = [
+  2, # $0: D1 - C1
+  2, # $1: E1 - D1
+  1, # $2: F1 - E1
+  4, # $3: A1 - F1
+  None,
+  2, # $5: B1 - A1
+  1, # $6: C2 - B1
+  2, # $7: D2 - C2
+  3, # $8: F2 - D2
+  2, # $9: G2 - F2
+  2, # $A: A2 - G2
+  3, # $B: C3 - A2
+  4, # $C: E3 - C3
+  8, # $D: C4 - E3
+  None,
+  None,
+]
 
 # in cents, compared to rate + $1
-repitching_error = [None] * 16
-repitching_error[0xE] = 2.0
-repitching_error[0xD] = 33.1
-repitching_error[0xC] = -2.7
-repitching_error[0xB] = -26.5
-repitching_error[0xA] = 20.3
-repitching_error[0x9] = -6.6
-repitching_error[0x8] = 2.5
-repitching_error[0x7] = -5.9
-repitching_error[0x6] = 5.5
-repitching_error[0x5] = -2.2
-repitching_error[0x4] = -5.4
-repitching_error[0x3] = 5.5
-repitching_error[0x2] = -5.0
-repitching_error[0x1] = 7.4
-repitching_error[0x0] = -5.9
+repitching_error = [
+  -5.9, 7.4, -5.0, 5.5, -5.4, -2.2, 5.5, -5.9,
+  2.5, -6.6, 20.3, -26.5, -2.7, 33.1, 2.0, None,
+]
 
 def cumulative_repitching_error(reference_rate, target_rate):
   if reference_rate == target_rate:
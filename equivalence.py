@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Differential checks of the production engines against the frozen reference
+# copies in reference.py. Random inputs are fuzzed through both and the outputs
+# compared exactly; on a mismatch the inputs and the first divergent byte (or
+# entry) are reported. Whole instruments can also be checked against golden
+# .fti files recorded from a known good tree.
+
+import benchmark
+import dpcm
+import fti
+import looper
+import midi
+import pack
+import reference
+import repitcher
+import splitter
+import waveform
+
+# python stdlib
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import math
+import os
+import random
+import tempfile
+import time
+
+EDGE_PCM = [0, 1, 2, 3, 126, 127, 128, 129, 252, 253, 254, 255, 256, -1, -2, 257, 127.5, 128.5, 0.5, 254.5]
+
+def random_pcm(rng):
+    length = rng.choice([1, 2, 3, 7, 8, 9, 15, 16, 17, rng.randint(1, 96)])
+    style = rng.randrange(4)
+    if style == 0:
+        return [rng.choice(EDGE_PCM) for i in range(0, length)]
+    if style == 1:
+        return [rng.randint(0, 255) for i in range(0, length)]
+    if style == 2:
+        # even values land exactly on encoder levels, which exercises ties
+        return [rng.randrange(0, 256, 2) for i in range(0, length)]
+    return [rng.uniform(-16.0, 272.0) for i in range(0, length)]
+
+def random_starting_level(rng):
+    return rng.choice([None, None, 0, 1, 63, 64, 126, 127, 63.5, rng.randint(0, 127), rng.uniform(0.0, 127.0)])
+
+def case_pack_bits(rng):
+    return ([rng.randint(0, 1) for i in range(0, rng.randint(0, 80))],)
+
+def case_to_dpcm(rng):
+    return (random_pcm(rng), random_starting_level(rng))
+
+def case_stream_encoder(rng):
+    (pcm, starting_level) = case_to_dpcm(rng)
+    # empty blocks are allowed, but at least one has to move the stream along
+    block_sizes = [rng.choice([0, 1, 3, 7, 8, 9, rng.randint(1, 64)]) for i in range(0, rng.randint(0, 11))]
+    block_sizes.append(rng.randint(1, 64))
+    return (pcm, starting_level, block_sizes)
+
+def case_bias(rng):
+    return (bytes(rng.randint(0, 255) for i in range(0, rng.randint(0, 64))),)
+
+def case_ideal_tunings(rng):
+    target_frequency = rng.choice([rng.choice(midi.frequency), rng.uniform(8.0, 4200.0)])
+    playback_rate = rng.choice([rate for rate in dpcm.playback_rate])
+    max_length = rng.choice([1, 2, rng.randint(1, 32), rng.randint(1, 32), 255])
+    return (target_frequency, playback_rate, max_length)
+
+def case_write_instrument(rng):
+    name = "".join(rng.choice("ABCxyz019 -_") for i in range(0, rng.randint(0, 127)))
+    note_mappings = []
+    for i in range(0, rng.randint(0, 24)):
+        note_mappings.append({
+            "midi_index": rng.randint(12, 138),
+            "sample_index": rng.randint(0, 64),
+            "pitch": rng.randint(0, 15),
+            "looping": rng.random() < 0.5,
+            "delta": rng.randint(-1, 127),
+        })
+    samples = []
+    for i in range(0, rng.randint(0, 8)):
+        samples.append({
+            "name": "".join(rng.choice("abcXYZ-_0123") for j in range(0, rng.randint(0, 24))),
+            "data": bytes(rng.randint(0, 255) for j in range(0, rng.randint(0, 64))),
+        })
+    return (name, note_mappings, samples)
+
+def write_instrument(writer):
+    def write(instrument_name, note_mappings, samples):
+        output = io.BytesIO()
+        writer(output, instrument_name, note_mappings, samples)
+        return output.getvalue()
+    return write
+
+def whole(encode):
+    def run(pcm_samples, starting_level, block_sizes):
+        return encode(list(pcm_samples), starting_level)
+    return run
+
+# Feeds the PCM to a StreamEncoder in blocks of the given sizes (cycling through
+# them) and joins what comes out.
+def streamed(pcm_samples, starting_level, block_sizes):
+    stream = dpcm.StreamEncoder(starting_level)
+    output = bytearray()
+    position = 0
+    block = 0
+    while position < len(pcm_samples):
+        size = block_sizes[block % len(block_sizes)]
+        output += stream.encode(pcm_samples[position:position + size])
+        position += size
+        block += 1
+    output += stream.flush()
+    return bytes(output)
+
+def copied(engine):
+    # the pure Python engines mutate their list arguments (the bit packer pads
+    # its input in place), so each side gets its own copy
+    def run(*args):
+        return engine(*[list(arg) if isinstance(arg, list) else arg for arg in args])
+    return run
+
+# name -> (case generator, reference engine, production engine)
+engines = {
+    "pack_bits": (case_pack_bits, copied(reference.pack_dpcm_bits_into_bytes), copied(dpcm.pack_dpcm_bits_into_bytes)),
+    "to_dpcm": (case_to_dpcm, copied(reference.to_dpcm), copied(dpcm.to_dpcm)),
+    "stream_encoder": (case_stream_encoder, whole(reference.to_dpcm), streamed),
+    "bias": (case_bias, reference.bias, dpcm.bias),
+    "ideal_tunings": (case_ideal_tunings, reference.ideal_tunings, looper.ideal_tunings),
+    "write_instrument": (case_write_instrument, write_instrument(reference.write_dpcm_instrument), write_instrument(fti.write_dpcm_instrument)),
+}
+
+# Describes where two outputs first part ways, or returns None if they match.
+def first_difference(expected, actual):
+    if type(expected) != type(actual):
+        return "type {} != {}".format(type(expected).__name__, type(actual).__name__)
+    if isinstance(expected, (bytes, bytearray, list)):
+        for i in range(0, min(len(expected), len(actual))):
+            difference = first_difference(expected[i], actual[i])
+            if difference:
+                if isinstance(expected, list):
+                    return "[{}] {}".format(i, difference)
+                return "byte {}: {:#04x} != {:#04x}".format(i, expected[i], actual[i])
+        if len(expected) != len(actual):
+            return "length {} != {} (first extra at {})".format(len(expected), len(actual), min(len(expected), len(actual)))
+        return None
+    if isinstance(expected, dict):
+        for key in expected:
+            if key not in actual:
+                return "missing key {!r}".format(key)
+            difference = first_difference(expected[key], actual[key])
+            if difference:
+                return "[{!r}] {}".format(key, difference)
+        for key in actual:
+            if key not in expected:
+                return "extra key {!r}".format(key)
+        return None
+    if expected != actual:
+        return "{!r} != {!r}".format(expected, actual)
+    return None
+
+def outcome(engine, args):
+    try:
+        return ("ok", engine(*args))
+    except Exception as e:
+        return ("raised", type(e).__name__)
+
+# Runs count cases of one engine from one seed. Returns the number run, and a
+# description of the first mismatch (or None).
+def fuzz(name, seed, count):
+    (generate, reference_engine, production_engine) = engines[name]
+    rng = random.Random("{}-{}".format(name, seed))
+    for i in range(0, count):
+        args = generate(rng)
+        (expected_kind, expected) = outcome(reference_engine, args)
+        (actual_kind, actual) = outcome(production_engine, args)
+        if expected_kind != actual_kind:
+            difference = "reference {} {!r}, production {} {!r}".format(expected_kind, expected, actual_kind, actual)
+        else:
+            difference = first_difference(expected, actual)
+        if difference:
+            return i + 1, "{} case {} of seed {}: {}\n    inputs: {}".format(name, i, seed, difference, repr(args)[0:2000])
+    return count, None
+
+# Instruments which exercise the whole pipeline, from generation to .fti.
+def golden_instruments():
+    instruments = {}
+    for label, generator, notes, volume, bias in [
+        ("sine", waveform.sine, [48, 55, 60], 1.0, 0),
+        ("sawtooth", waveform.sawtooth, [34, 38, 50], 1.0, 0),
+        ("triangle", waveform.triangle, [60, 64], 0.5, 1),
+        ("ramp", waveform.artificial_ramp, [36, 72], 1.0, 0)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sample_table, note_mappings = looper.generate_samples(generator, notes, volume=volume, target_bias=bias, prefix=label, quiet=True)
+        note_mappings = fti.fill_lower_samples(note_mappings)
+        instruments["looper-" + label] = (sample_table, note_mappings)
+
+    source_frames = benchmark.synthesize_pcm(0.25)
+    source_data = splitter.fix_sample_width(source_frames, 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sample_table, note_mappings = repitcher.generate_repitched_instrument(source_data, benchmark.SOURCE_RATE, "C4", "c3,g3,c4,c5", prefix="source")
+    instruments["repitcher"] = (sample_table, fti.fill_lower_samples(note_mappings))
+
+    chunks = splitter.split_chunks(dpcm.to_dpcm(source_data), 256, 337)
+    output = io.BytesIO()
+    (samples, sample_indices) = splitter.fit_instrument(*splitter.alias_chunks(chunks))
+    splitter.compile_instrument(output, "DPCM splitter", samples, sample_indices)
+    instruments["splitter"] = output.getvalue()
+
+    golden = {}
+    for name, instrument in instruments.items():
+        if isinstance(instrument, bytes):
+            golden[name + ".fti"] = instrument
+            continue
+        (sample_table, note_mappings) = instrument
+        output = io.BytesIO()
+        fti.write_dpcm_instrument(output, "DPCM " + name, note_mappings, sample_table)
+        golden[name + ".fti"] = output.getvalue()
+    return golden
+
+def check_golden(directory):
+    failures = []
+    for filename, data in golden_instruments().items():
+        golden_filename = os.path.join(directory, filename)
+        if not os.path.exists(golden_filename):
+            failures.append("{}: no golden file".format(golden_filename))
+            continue
+        with io.open(golden_filename, "rb") as golden_file:
+            difference = first_difference(golden_file.read(), data)
+        if difference:
+            failures.append("{}: {}".format(golden_filename, difference))
+    return failures
+
+def write_golden(directory):
+    os.makedirs(directory, exist_ok=True)
+    for filename, data in golden_instruments().items():
+        output = io.open(os.path.join(directory, filename), "wb")
+        output.write(data)
+        output.close()
+        print("Wrote {}".format(os.path.join(directory, filename)))
+
+# Splits a source with silence and a repeated section into every kind of output,
+# and checks that the song can be put back together, chunk by chunk and in
+# order, from each one alone.
+def check_split_order():
+    split_seconds = 0.125
+    split_length = math.floor(split_seconds * dpcm.playback_rate[0xF] / 8)
+    section = splitter.fix_sample_width(benchmark.synthesize_pcm(2 * split_length * 8 / benchmark.SOURCE_RATE), 2)[0:2 * split_length * 8]
+    silence = [128.0] * (2 * split_length * 8)
+    source_data = silence + section + silence + section + silence
+    with contextlib.redirect_stdout(io.StringIO()):
+        chunks = splitter.split_chunks(dpcm.to_dpcm(source_data), split_length, (math.floor(split_length / 16) + 5) * 16 + 1)
+        (samples, sample_indices) = splitter.alias_chunks(chunks)
+    expected = [bytes(samples[i][1]) for i in sample_indices]
+    failures = []
+    if len(samples) == len(chunks):
+        failures.append("split order: no chunks were aliased, nothing was checked")
+    with tempfile.TemporaryDirectory() as directory:
+        args = splitter.build_parser().parse_args([
+            "source.wav", str(split_seconds),
+            "-s", os.path.join(directory, "chunks"),
+            "-a", os.path.join(directory, "song.pack")])
+        zip_args = splitter.build_parser().parse_args(["source.wav", str(split_seconds), "-a", os.path.join(directory, "song.zip")])
+        with contextlib.redirect_stdout(io.StringIO()):
+            splitter.run(args, source=(source_data, benchmark.SOURCE_RATE))
+            splitter.run(zip_args, source=(source_data, benchmark.SOURCE_RATE))
+        rebuilt = {}
+        for archive_name in ["song.pack", "song.zip"]:
+            with pack.ArchiveReader(os.path.join(directory, archive_name)) as reader:
+                rebuilt[archive_name] = [reader.read(name) for name in sorted(reader.names())]
+        chunk_directory = os.path.join(directory, "chunks")
+        rebuilt["chunks/"] = []
+        for name in sorted(os.listdir(chunk_directory)):
+            with io.open(os.path.join(chunk_directory, name), "rb") as chunk_file:
+                rebuilt["chunks/"].append(chunk_file.read())
+        for output, found in rebuilt.items():
+            if found != expected:
+                failures.append("split order: {}: {}".format(output, first_difference(expected, found)))
+        packed_size = os.path.getsize(os.path.join(directory, "song.pack"))
+        if packed_size >= sum(len(chunk) for chunk in expected):
+            failures.append("split order: song.pack stores shared samples more than once ({} bytes)".format(packed_size))
+    return failures
+
+def main(argv=None):
+    examples = """
+    Examples:
+      A quick check of every engine:
+        %(prog)s -n 10000
+
+      A million to_dpcm cases over every core:
+        %(prog)s -e to_dpcm -n 1000000 -j 8
+
+      Record golden instruments before a change, then check them after:
+        %(prog)s -n 0 --write-golden golden/
+        %(prog)s --golden golden/
+    """
+    parser = argparse.ArgumentParser(
+        description="Fuzz the production engines against the frozen reference engines",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=examples)
+    parser.add_argument("-e", "--engine", action="append", help="One of: {} (default: all; may be repeated)".format(", ".join(engines.keys())), choices=engines)
+    parser.add_argument("-n", "--cases", help="Cases per engine (default: 100000)", type=int, default=100000)
+    parser.add_argument("--seed", help="First seed (default: 0)", type=int, default=0)
+    parser.add_argument("-j", "--jobs", help="Worker processes (default: 1)", type=int, default=1)
+    parser.add_argument("--golden", help="Check whole instruments against golden .fti files in this directory")
+    parser.add_argument("--write-golden", dest="write_golden", help="Record golden .fti files from this tree into this directory")
+    args = parser.parse_args(argv)
+
+    if args.write_golden:
+        write_golden(args.write_golden)
+
+    failures = []
+    # each engine's cases are cut into seeded chunks, so the work spreads over
+    # the pool and any failure can be replayed from its seed alone
+    chunk_size = 10000
+    work = []
+    for name in args.engine or engines.keys():
+        seed = args.seed
+        remaining = args.cases
+        while remaining > 0:
+            work.append((name, seed, min(chunk_size, remaining)))
+            remaining -= chunk_size
+            seed += 1
+    start_time = time.perf_counter()
+    counts = {}
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = executor.map(fuzz, *zip(*work)) if work else []
+            for (name, seed, count), (ran, failure) in zip(work, results):
+                counts[name] = counts.get(name, 0) + ran
+                if failure:
+                    failures.append(failure)
+    else:
+        for (name, seed, count) in work:
+            (ran, failure) = fuzz(name, seed, count)
+            counts[name] = counts.get(name, 0) + ran
+            if failure:
+                failures.append(failure)
+    elapsed = time.perf_counter() - start_time
+    for name, count in counts.items():
+        print("{}: {} cases".format(name, count))
+    if counts:
+        print("{} cases in {:.2f}s ({:.0f}/s)".format(sum(counts.values()), elapsed, sum(counts.values()) / max(elapsed, 1e-9)))
+
+    failures += check_split_order()
+    print("Checked split chunk order")
+
+    if args.golden:
+        failures += check_golden(args.golden)
+        print("Checked golden instruments in {}".format(args.golden))
+
+    if failures:
+        exit("Mismatches:\n  " + "\n  ".join(failures))
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -70,6 +70,45 @@ def write_dpcm_instrument(file, instrument_name, note_mappings, samples):
     write_int(file, sample_index)
     write_sample_data(file, sample["name"], sample["data"])
 
+def read_char(file):
+  return struct.unpack("b", file.read(1))[0]
+
+def read_uchar(file):
+  return struct.unpack("B", file.read(1))[0]
+
+def read_int(file):
+  return struct.unpack("i", file.read(4))[0]
+
+def read_string(file, length):
+  return file.read(length).decode("ascii")
+
+# Reads back what write_dpcm_instrument writes (and nothing fancier). Note
+# mappings come back in the same form, with 1-based sample indices, and samples
+# as a list ordered by their index in the file.
+def read_dpcm_instrument(file):
+  if read_string(file, len(INST_HEADER)) != INST_HEADER:
+    raise Exception("Not a FamiTracker instrument")
+  read_string(file, len(INST_VERSION))
+  if read_char(file) != INST_2A03:
+    raise Exception("Not a 2A03 instrument")
+  instrument_name = read_string(file, read_int(file))
+  if read_char(file) != 0:
+    raise Exception("Instruments with sequences are not supported")
+  note_mappings = []
+  for i in range(0, read_int(file)):
+    note_index = read_char(file)
+    sample_index = read_char(file)
+    pitch_byte = read_uchar(file)
+    delta = read_char(file)
+    note_mappings.append({"midi_index": note_index + 12, "sample_index": sample_index, "pitch": pitch_byte & 0xF, "looping": (pitch_byte & 0x80) != 0, "delta": delta})
+  samples_by_index = {}
+  for i in range(0, read_int(file)):
+    sample_index = read_int(file)
+    name = read_string(file, read_int(file))
+    samples_by_index[sample_index] = {"name": name, "data": file.read(read_int(file))}
+  samples = [samples_by_index.get(i) for i in range(0, max(samples_by_index.keys(), default=-1) + 1)]
+  return instrument_name, note_mappings, samples
+
 def note_by_index(note_mappings, index):
   for note_mapping in note_mappings:
     if note_mapping["midi_index"] == index:
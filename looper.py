@@ -2,13 +2,16 @@
 
 import dpcm
 import fti
+import metrics
 import midi
+import pack
 import waveform
 
 # python stdlib
 import argparse
 import io
 import os
+import time
 import wave
 
 def _tuning_error(a):
@@ -34,9 +37,16 @@ def ideal_tunings(target_frequency, playback_rate, max_length):
     tunings.sort(key=_tuning_error)
     return tunings
 
-def generate_tuning_table(playback_rate, max_length):
+# Tunings for every note the looper covers. Given a list of notes, only those are
+# searched and the rest of the table is left as None, which keeps short runs short.
+def generate_tuning_table(playback_rate, max_length, notes=None):
+    if notes != None:
+        notes = set(notes)
     tuning_table = []
     for i in range(0, 94):
+        if notes != None and i not in notes:
+            tuning_table.append(None)
+            continue
         target = midi.frequency[i]
         tuning_table.append(ideal_tunings(target, playback_rate, max_length))
     return tuning_table
@@ -49,7 +59,26 @@ def smallest_acceptable(ideal_tunings, threshold):
     acceptable_tunings.sort(key=_tuning_length)
     return acceptable_tunings[0]
 
-def generate_pcm(tuning, generator, playback_rate, amplitude, target_bias):
+# The generator's output over one tuning's samples, before volume and bias.
+# Sweeps keep these in buffers, keyed by tuning and generator, so variants which
+# only differ in volume or bias synthesise each note once. The phase of every
+# sample is kept too, and shared between generators.
+def waveform_buffer(buffers, tuning, generator, playback_rate):
+    phase_key = (tuning["samples"], tuning["effective_frequency"], playback_rate)
+    key = phase_key + (generator,)
+    if key not in buffers:
+        if phase_key not in buffers:
+            buffers[phase_key] = [i * tuning["effective_frequency"] / playback_rate for i in range(0, tuning["samples"])]
+        buffers[key] = [generator(dt) for dt in buffers[phase_key]]
+    return buffers[key]
+
+def generate_pcm(tuning, generator, playback_rate, amplitude, target_bias, buffers=None):
+    if buffers != None:
+        # the same arithmetic as below, in the same order, so sweeps come out
+        # byte for byte the same as single runs
+        samples = waveform_buffer(buffers, tuning, generator, playback_rate)
+        biases = waveform_buffer(buffers, tuning, waveform.bias, playback_rate)
+        return [(sample * amplitude + bias * target_bias) * 256 for sample, bias in zip(samples, biases)]
     pcm = []
     for i in range(0, tuning["samples"]):
         sample = waveform.sample(generator, i, tuning["effective_frequency"], playback_rate) * amplitude
@@ -79,10 +108,15 @@ def generate_mapping(sample_table, target_note_name, source_sample_name, source_
     return mapping
 
 def generate_samples(waveform_generator, note_list, volume=1.0, use_safe_amplitude=True, target_bias=0.0, set_delta=-1,
-        playback_index=0xF, error_threshold=0.0, max_length_bytes=255, prefix=None, quiet=False):    
+        playback_index=0xF, error_threshold=0.0, max_length_bytes=255, prefix=None, quiet=False,
+        encoder=dpcm.to_dpcm, compare_encoders=False, search_delta=False, tuning_table=None, stats=None,
+        buffers=None, report=None):
+    stats = stats or metrics.Metrics()
     playback_rate = dpcm.playback_rate[playback_index]
     print("Playback rate: ", playback_rate)
-    tuning_table = generate_tuning_table(playback_rate, max_length_bytes)
+    if tuning_table == None:
+        with stats.stage("tuning", units=len(set(note_list)), unit_name="notes"):
+            tuning_table = generate_tuning_table(playback_rate, max_length_bytes, note_list)
     sample_table = []
     note_mappings = []
     sample_index = 1
@@ -90,24 +124,59 @@ def generate_samples(waveform_generator, note_list, volume=1.0, use_safe_amplitu
     if prefix:
         sample_prefix = prefix + "-"
     for i in note_list:
-        tuning = smallest_acceptable(tuning_table[i], error_threshold)
+        sample_name = midi.note_name(i)
+        with stats.stage("selection", units=1, unit_name="notes", note=sample_name):
+            tuning = smallest_acceptable(tuning_table[i], error_threshold)
         target_amplitude = volume
         if use_safe_amplitude:
             target_amplitude = dpcm.safe_amplitude(tuning["effective_frequency"], playback_rate) * volume
-        pcm = generate_pcm(tuning, waveform_generator, playback_rate, target_amplitude, target_bias)
+        with stats.stage("synthesis", units=tuning["samples"], unit_name="samples", note=sample_name):
+            pcm = generate_pcm(tuning, waveform_generator, playback_rate, target_amplitude, target_bias, buffers)
+        starting_level = None
+        sample_encoder = encoder
         if waveform_generator in [waveform.artificial_ramp, waveform.floored_artificial_ramp, waveform.ceilinged_artificial_ramp]:
-            dpcm_data = dpcm.to_dpcm(pcm, starting_level=0)
-        else:
-            dpcm_data = dpcm.to_dpcm(pcm)
-        sample_name = midi.note_name(i)
+            # the ramps are bit patterns rather than real waveforms, and only
+            # come out right from the greedy encoder
+            starting_level = 0
+            sample_encoder = dpcm.to_dpcm
+        delta = set_delta
+        # the same PCM always encodes the same way, so sweep variants which end
+        # up with the same tuning, volume and bias for a note share its encoding
+        encoding_key = ("encoding", tuning["samples"], tuning["effective_frequency"], playback_rate,
+            waveform_generator, target_amplitude, target_bias, sample_encoder, search_delta)
+        with stats.stage("encoding", units=len(pcm), unit_name="samples", note=sample_name):
+            # shared encodings keep the time they first took, for --compare-encoders
+            if buffers != None and encoding_key in buffers:
+                (dpcm_data, loop_start, encoding_seconds) = buffers[encoding_key]
+            else:
+                start_time = time.perf_counter()
+                if search_delta:
+                    loop_start = dpcm.best_loop_start(pcm, sample_encoder)
+                    dpcm_data = loop_start["data"]
+                else:
+                    loop_start = None
+                    dpcm_data = sample_encoder(pcm, starting_level=starting_level)
+                encoding_seconds = time.perf_counter() - start_time
+            if buffers != None:
+                buffers[encoding_key] = (dpcm_data, loop_start, encoding_seconds)
+            if search_delta:
+                starting_level = delta = loop_start["delta"]
         sample_table.append({"name": sample_prefix+sample_name, "data": dpcm_data})
-        note_mappings.append({"midi_index": i + 12, "sample_index": sample_index, "pitch": playback_index, "looping": True, "delta": set_delta})
+        note_mappings.append({"midi_index": i + 12, "sample_index": sample_index, "pitch": playback_index, "looping": True, "delta": delta})
         sample_index += 1
-        bias = dpcm.bias(dpcm_data)
+        with stats.stage("bias", units=len(dpcm_data) * 8, unit_name="bits", note=sample_name):
+            bias = dpcm.bias(dpcm_data)
+        if report != None:
+            report.append({"note": sample_name, "error": tuning["error"], "size": len(dpcm_data), "repetitions": tuning["repetitions"],
+                "effective_frequency": tuning["effective_frequency"], "amplitude": target_amplitude, "bias": bias})
         if not quiet:
             print("{}: Err: {:.2f}, Size: {}, Reps: {}, E. Freq: {:.2f}, E.Ampl {:.2f}, Bias: {}".format(
-                midi.note_name(i), tuning["error"], tuning["size"], tuning["repetitions"],
+                sample_name, tuning["error"], tuning["size"], tuning["repetitions"],
                 tuning["effective_frequency"], target_amplitude, bias))
+            if search_delta:
+                print("    Delta: {}, Drift: {}, MSE: {:.3f}".format(delta, loop_start["drift"], loop_start["error"]))
+            if compare_encoders:
+                print("    " + dpcm.format_comparison(dpcm.compare_encoders(pcm, dpcm_data, encoding_seconds, starting_level)))
     return sample_table, note_mappings
 
 def full_instrument_name(args):
@@ -120,13 +189,15 @@ def sample_prefix(args):
     if args.instrument:
         (nicename, ext) = os.path.splitext(os.path.basename(args.instrument))
         return nicename
+    if args.archive:
+        (nicename, ext) = os.path.splitext(os.path.basename(args.archive))
+        return nicename
     if args.directory:
         (head, tail) = os.path.split(args.directory)
         return tail
     return None
 
-def main():
-    examples = """
+examples = """
     Examples:
       Sawtooth, Sunsoft style:
         %(prog)s -g sawtooth -i sunsaw.fti as2-d3
@@ -136,17 +207,57 @@ def main():
 
       Custom waveform:
         %(prog)s -g wave -w organ.wav -i organ.fti c4-c5
+
+      Sweep, one instrument per combination (tri-v0.25-b0.fti ... tri-v1-b1.fti):
+        %(prog)s -g triangle -v 0.25:1:0.25 -b 0,1 -i tri.fti c4-c5
     """
-    generators = {
-        "sine": waveform.sine, 
-        "square": waveform.square, 
-        "triangle": waveform.triangle, 
-        "sawtooth": waveform.sawtooth, 
-        "wave": waveform.wave_file, 
-        "artificial_ramp": waveform.artificial_ramp,
-        "floored_artificial_ramp": waveform.floored_artificial_ramp,
-        "ceilinged_artificial_ramp": waveform.ceilinged_artificial_ramp,
-    }
+
+# Parses a comma separated list, where each entry is a value or an inclusive
+# start:stop[:step] range, for the options a sweep can vary. Repeated values are
+# only kept once, since they would write the same outputs again.
+def sweep_list(value_type):
+    def parse(text):
+        values = []
+        for entry in text.split(","):
+            try:
+                if ":" not in entry:
+                    values.append(value_type(entry))
+                    continue
+                bounds = [value_type(x) for x in entry.split(":")]
+                if len(bounds) == 2:
+                    bounds.append(1)
+                (start, stop, step) = bounds
+                if step <= 0:
+                    raise ValueError(entry)
+                count = int(round((stop - start) / step, 9)) + 1
+                if count <= 0:
+                    raise argparse.ArgumentTypeError("empty range: {!r} (stop is below start)".format(entry))
+                # rounded, so 0.1 steps don't come out as 0.30000000000000004
+                values += [value_type(round(start + i * step, 9)) for i in range(0, count)]
+            except ValueError:
+                raise argparse.ArgumentTypeError("invalid value or range: {!r}".format(entry))
+        return list(dict.fromkeys(values))
+    return parse
+
+def generator_list(text):
+    names = text.split(",")
+    for name in names:
+        if name not in generators:
+            raise argparse.ArgumentTypeError("invalid choice: {!r} (choose from {})".format(name, ", ".join(generators.keys())))
+    return list(dict.fromkeys(names))
+
+generators = {
+    "sine": waveform.sine, 
+    "square": waveform.square, 
+    "triangle": waveform.triangle, 
+    "sawtooth": waveform.sawtooth, 
+    "wave": waveform.wave_file, 
+    "artificial_ramp": waveform.artificial_ramp,
+    "floored_artificial_ramp": waveform.floored_artificial_ramp,
+    "ceilinged_artificial_ramp": waveform.ceilinged_artificial_ramp,
+}
+
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Automatically generate looping DPCM samples", 
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -154,41 +265,153 @@ def main():
     parser.add_argument("notes", help="Notes to generate. Ex: gs2,f3-a3")
     parser.add_argument("-s", "--directory", help="Directory to store generated samples as .dmc")
     parser.add_argument("-i", "--instrument", help="FamiTracker instrument filename to generate")
+    parser.add_argument("-a", "--archive", help="Store generated samples in one .pack (or .zip) archive")
     parser.add_argument("--prefix", help="Samples will be named [prefix]-[note] (default: filename)")
 
     generator_group = parser.add_argument_group("Sample Generation")
     generator_group.add_argument("-g", "--generator", metavar="GENERATOR", 
-        help="One of: {}".format(", ".join(generators.keys())), 
-        choices=generators, default="sine")
+        help="One of: {}. A comma separated list sweeps them all".format(", ".join(generators.keys())), 
+        type=generator_list, default=["sine"])
     generator_group.add_argument("-w", "--wavefile", help="For the wave generator. Should contain one loop, like N163.")
-    generator_group.add_argument("-v", "--volume", help="Linear volume multiplier for generated waveforms", type=float, default=1.0)
-    generator_group.add_argument("-e", "--error-threshold", help="Prefer smaller samples within this tuning percentage (default: 0%%)", type=float, default=0.0)
-    generator_group.add_argument("-b", "--bias", help="Bias generated samples in this direction. (default: 0)", type=int, default=0)
+    generator_group.add_argument("-v", "--volume", help="Linear volume multiplier for generated waveforms. Lists and start:stop:step ranges sweep (default: 1.0)", type=sweep_list(float), default=[1.0])
+    generator_group.add_argument("-e", "--error-threshold", help="Prefer smaller samples within this tuning percentage. Sweeps like -v (default: 0%%)", type=sweep_list(float), default=[0.0])
+    generator_group.add_argument("-b", "--bias", help="Bias generated samples in this direction. Sweeps like -v (default: 0)", type=sweep_list(int), default=[0])
     generator_group.add_argument("-l", "--max-length", help="Longest sample size to consider. Generally improves tuning, costs more space. (default: 255)", type=int, default=255)
     generator_group.add_argument("-r", "--playback-rate", help="Base rate for sample playback. Defaults to 0xF, 33143 Hz", type=int, default=0xF)
     generator_group.add_argument("--safe-volume", dest="safe_volume", help="Scale volume for high notes, to avoid triangle shape creep. (default: True)", action='store_true')
     generator_group.add_argument("--no-safe-volume", dest="safe_volume", help="Do not scale volume", action='store_false')
 
+    encoder_group = parser.add_argument_group("DPCM Encoding")
+    encoder_group.add_argument("--encoder", help="One of: {} (default: greedy)".format(", ".join(dpcm.encoder_names)),
+        choices=dpcm.encoder_names, default="greedy")
+    encoder_group.add_argument("--lookahead", help="Trellis window in samples, 0 for the whole sample. Bounds memory on long inputs, but encodes more slowly. (default: 0)", type=dpcm.lookahead_length, default=0)
+    encoder_group.add_argument("--compare-encoders", dest="compare_encoders", help="Report error and speed against the greedy encoder", action='store_true')
+
     instrument_group = parser.add_argument_group("FamiTracker Instruments")
     instrument_group.add_argument("-d", "--delta", help="Set the delta counter when playback begins", type=int, default=-1)
+    instrument_group.add_argument("--search-delta", dest="search_delta", help="Pick the delta counter for each note which keeps its loop from drifting. Overrides -d", action='store_true')
     instrument_group.add_argument("--repitch", dest="repitch", help="Fill out an instrument's lower range with repitched samples (default: True)", action='store_true')
     instrument_group.add_argument("--no-repitch", dest="repitch", help="Do not fill out the instrument's lower range", action='store_false')
     instrument_group.add_argument("--pal-safe-repitch", dest="palsafe", help="Avoid pitches $4 and $E when repitching (default False)", action='store_true')
     instrument_group.add_argument("--fullname", help="The full name of this instrument, show in FamiTracker's UI")
     instrument_group.set_defaults(repitch=True, safe_volume=True, palsafe=False)
 
-    args = parser.parse_args()
+    profile_group = parser.add_argument_group("Profiling")
+    profile_group.add_argument("--profile", help="Report time, throughput and peak memory per stage and note, and save a cProfile dump next to the output", action='store_true')
+    profile_group.add_argument("--stats-json", dest="stats_json", help="Write the per-stage report to this JSON file")
+    return parser
 
-    generator = generators[args.generator]
-    if args.generator == "wave":
+# A wave generator already read from args.wavefile (say, one kept warm by batch)
+# may be passed in, to skip reading the file again.
+def resolve_generator(args, generator_name, wave_generator=None):
+    if generator_name == "wave":
+        if wave_generator:
+            return wave_generator
         if args.wavefile:
-            generator = waveform.wave_file(args.wavefile)
+            return waveform.wave_file(args.wavefile)
         else:
             exit("Error: wave generator requires -w, --waveform")
+    return generators[generator_name]
 
-    if not args.instrument and not args.directory:
-        exit("Error: Missing output! (-i, --instrument; or -d, --directory)\nYou asked me to do nothing, so I will do just that.")
+# Every combination of the swept options, in the order they are generated. Each
+# is labelled by the options that actually vary, which is empty for a single run.
+def sweep_variants(args):
+    swept = {
+        "generator": args.generator,
+        "volume": args.volume,
+        "bias": args.bias,
+        "error_threshold": args.error_threshold,
+    }
+    variants = [{}]
+    for option, values in swept.items():
+        variants = [dict(variant, **{option: value}) for variant in variants for value in values]
+    for variant in variants:
+        label = []
+        if len(args.generator) > 1:
+            label.append(variant["generator"])
+        if len(args.volume) > 1:
+            label.append("v{:g}".format(variant["volume"]))
+        if len(args.bias) > 1:
+            label.append("b{:g}".format(variant["bias"]))
+        if len(args.error_threshold) > 1:
+            label.append("e{:g}".format(variant["error_threshold"]))
+        variant["label"] = "-".join(label)
+    return variants
+
+def labelled_path(path, label):
+    if not path or not label:
+        return path
+    (root, ext) = os.path.splitext(os.path.normpath(path))
+    return "{}-{}{}".format(root, label, ext)
+
+# A copy of args for one variant, with single values in place of the swept
+# lists and the variant's label on every output.
+def variant_args(args, variant):
+    single_args = argparse.Namespace(**vars(args))
+    single_args.generator = variant["generator"]
+    single_args.volume = variant["volume"]
+    single_args.bias = variant["bias"]
+    single_args.error_threshold = variant["error_threshold"]
+    single_args.instrument = labelled_path(args.instrument, variant["label"])
+    single_args.directory = labelled_path(args.directory, variant["label"])
+    single_args.archive = labelled_path(args.archive, variant["label"])
+    if args.fullname and variant["label"]:
+        single_args.fullname = "{} {}".format(args.fullname, variant["label"])
+    return single_args
+
+def format_sweep(rows):
+    lines = ["{:<24} {:>8} {:>8} {:>9} {:>9}  {}".format("Variant", "Size", "Max Err", "Mean Err", "Max Bias", "Output")]
+    for row in rows:
+        lines.append("{:<24} {:>8} {:>8.3f} {:>9.3f} {:>9}  {}".format(
+            row["label"], row["size"], row["max_error"], row["mean_error"], row["max_bias"], ", ".join(row["paths"])))
+    return "\n".join(lines)
+
+# Generates and writes everything asked for by parsed command line arguments,
+# and returns the paths written. A precomputed tuning table for the chosen rate
+# and max length may be passed in, to share it between runs, as may a Metrics.
+# With more than one generator, volume, bias or error threshold, every
+# combination is generated from one tuning table and one set of synthesised
+# waveforms, and compared in a table at the end.
+def run(args, tuning_table=None, stats=None, wave_generator=None):
+    stats = stats or metrics.Metrics()
+    if not args.instrument and not args.directory and not args.archive:
+        exit("Error: Missing output! (-i, --instrument; -s, --directory; or -a, --archive)\nYou asked me to do nothing, so I will do just that.")
+
+    variants = sweep_variants(args)
+    if len(variants) == 1:
+        single_args = variant_args(args, variants[0])
+        return generate_instrument(single_args, resolve_generator(single_args, single_args.generator, wave_generator), tuning_table, stats)
 
+    if tuning_table == None:
+        notes = midi.parse_note_list(args.notes)
+        with stats.stage("tuning", units=len(set(notes)), unit_name="notes"):
+            tuning_table = generate_tuning_table(dpcm.playback_rate[args.playback_rate], args.max_length, notes)
+    resolved_generators = {name: resolve_generator(args, name, wave_generator) for name in args.generator}
+    encoder = dpcm.encoder(args.encoder, args.lookahead)
+    buffers = {}
+    written_paths = []
+    rows = []
+    for variant in variants:
+        report = []
+        paths = generate_instrument(variant_args(args, variant), resolved_generators[variant["generator"]], tuning_table, stats,
+            quiet=True, buffers=buffers, report=report, encoder=encoder)
+        written_paths += paths
+        errors = [note["error"] for note in report]
+        rows.append({
+            "label": variant["label"],
+            "size": sum(note["size"] for note in report),
+            "max_error": max(errors, default=0.0),
+            "mean_error": sum(errors) / max(len(errors), 1),
+            "max_bias": max((abs(note["bias"]) for note in report), default=0),
+            "paths": paths,
+        })
+    print(format_sweep(rows))
+    return written_paths
+
+# One run of the looper, with single values for every option.
+def generate_instrument(args, generator, tuning_table=None, stats=None, quiet=False, buffers=None, report=None, encoder=None):
+    stats = stats or metrics.Metrics()
+    encoder = encoder or dpcm.encoder(args.encoder, args.lookahead)
     note_list = midi.parse_note_list(args.notes)
     sample_table, note_mappings = generate_samples(
         generator,
@@ -200,9 +423,18 @@ def main():
         max_length_bytes=args.max_length,
         set_delta=args.delta,
         prefix=sample_prefix(args),
-        playback_index=args.playback_rate
+        playback_index=args.playback_rate,
+        quiet=quiet,
+        tuning_table=tuning_table,
+        encoder=encoder,
+        compare_encoders=args.compare_encoders,
+        search_delta=args.search_delta,
+        stats=stats,
+        buffers=buffers,
+        report=report
         )
 
+    written_paths = []
     if args.instrument:
         instrument_filename = args.instrument
         (nicename, ext) = os.path.splitext(os.path.basename(instrument_filename))
@@ -211,21 +443,42 @@ def main():
         if args.palsafe == True:
             equivalency_table = dpcm.pal_safe_equivalency
 
-        note_mappings = fti.fill_lower_samples(note_mappings, equivalency_table=equivalency_table)
+        with stats.stage("packing", unit_name="bytes") as record:
+            note_mappings = fti.fill_lower_samples(note_mappings, equivalency_table=equivalency_table)
+            instrument = io.BytesIO()
+            fti.write_dpcm_instrument(instrument, full_instrument_name, note_mappings, sample_table)
+            record.units = len(instrument.getvalue())
 
-        output = io.open(instrument_filename, "wb")
-        fti.write_dpcm_instrument(output, full_instrument_name, note_mappings, sample_table)
-        output.close()
+        with stats.stage("write", units=len(instrument.getvalue()), unit_name="bytes"):
+            output = io.open(instrument_filename, "wb")
+            output.write(instrument.getvalue())
+            output.close()
+        written_paths.append(instrument_filename)
 
     if args.directory:
-        for note_mapping in note_mappings:
-            note_name = midi.note_name(note_mapping["midi_index"])
-            sample = sample_table[note_mapping["sample_index"] - 1]
-            sample_filename = os.path.join(args.directory, sample["name"]) + ".dmc"
-            os.makedirs(args.directory, exist_ok=True)
-            output = io.open(sample_filename, "wb")
-            output.write(sample["data"])
-            output.close()
+        with stats.stage("write", unit_name="bytes") as record:
+            for note_mapping in note_mappings:
+                note_name = midi.note_name(note_mapping["midi_index"])
+                sample = sample_table[note_mapping["sample_index"] - 1]
+                sample_filename = os.path.join(args.directory, sample["name"]) + ".dmc"
+                os.makedirs(args.directory, exist_ok=True)
+                output = io.open(sample_filename, "wb")
+                output.write(sample["data"])
+                output.close()
+                record.units += len(sample["data"])
+                if sample_filename not in written_paths:
+                    written_paths.append(sample_filename)
+
+    if args.archive:
+        with stats.stage("write", units=sum(len(sample["data"]) for sample in sample_table), unit_name="bytes"):
+            pack.write_archive(args.archive, [(sample["name"] + ".dmc", sample["data"]) for sample in sample_table])
+        written_paths.append(args.archive)
+    return written_paths
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.run_with_metrics(run, args)
+
 
 if __name__ == "__main__":
     # execute only if run as a script
@@ -0,0 +1,163 @@
+# Per-stage timing, throughput and peak memory for the tools. Library functions
+# accept an optional Metrics as stats, and wrap each pipeline stage in
+# stats.stage(); the command line tools create one for --profile and
+# --stats-json, and batch.py merges the reports of many jobs.
+
+# python stdlib
+import contextlib
+import io
+import os
+import time
+
+class StageRecord:
+    def __init__(self, units):
+        self.units = units
+
+class Metrics:
+    def __init__(self, track_memory=False):
+        self.stages = {}
+        self.notes = {}
+        self.track_memory = track_memory
+        self.started_tracing = False
+        # tracemalloc is loaded only when memory is tracked, so plain runs don't
+        # pay for it
+        self.tracemalloc = None
+        if track_memory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+        self.start_time = time.perf_counter()
+
+    # Times the body of a with block as one call of the named stage, optionally
+    # charged to a note as well. Units may be set on the yielded record once the
+    # body knows how much work it did. Stages are not meant to nest. A stage's
+    # peak is the most memory it had allocated above what was in use when it
+    # began.
+    @contextlib.contextmanager
+    def stage(self, name, units=0, unit_name="items", note=None):
+        record = StageRecord(units)
+        baseline = None
+        tracemalloc = self.tracemalloc
+        if tracemalloc:
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            elif self.started_tracing:
+                # Python 3.8 has no reset_peak, but tracing afresh forgets the
+                # earlier peak (and earlier allocations, so this starts from 0).
+                # Someone else's tracing is left alone, and gets no stage peaks.
+                tracemalloc.stop()
+                tracemalloc.start()
+                baseline = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start_time
+            peak = None
+            if baseline != None:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+            self.record(name, seconds, record.units, unit_name, peak, note)
+
+    def record(self, name, seconds, units=0, unit_name="items", peak=None, note=None):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "units": 0, "unit_name": unit_name, "peak_bytes": None})
+        stage["seconds"] += seconds
+        stage["calls"] += 1
+        stage["units"] += units
+        if peak != None:
+            stage["peak_bytes"] = max(stage["peak_bytes"] or 0, peak)
+        if note != None:
+            note_stages = self.notes.setdefault(note, {})
+            note_stage = note_stages.setdefault(name, {"seconds": 0.0, "units": 0, "peak_bytes": None})
+            note_stage["seconds"] += seconds
+            note_stage["units"] += units
+            if peak != None:
+                note_stage["peak_bytes"] = max(note_stage["peak_bytes"] or 0, peak)
+
+    def close(self):
+        if self.started_tracing:
+            self.tracemalloc.stop()
+            self.started_tracing = False
+
+    def report(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            stages[name]["units_per_second"] = stage["units"] / max(stage["seconds"], 1e-9)
+        return {
+            "total_seconds": time.perf_counter() - self.start_time,
+            "stages": stages,
+            "notes": self.notes,
+        }
+
+# Combines reports from several runs (say, every job in a batch) into one.
+def merge_reports(reports):
+    merged = Metrics()
+    total_seconds = 0.0
+    for report in reports:
+        total_seconds += report["total_seconds"]
+        for name, stage in report["stages"].items():
+            merged.record(name, stage["seconds"], stage["units"], stage["unit_name"], stage["peak_bytes"])
+            merged.stages[name]["calls"] += stage["calls"] - 1
+    result = merged.report()
+    result["total_seconds"] = total_seconds
+    del result["notes"]
+    return result
+
+def format_bytes(count):
+    if count == None:
+        return "-"
+    return "{:.1f} MiB".format(count / (1024 * 1024))
+
+def format_report(report, notes=True):
+    lines = ["{:<12} {:>10} {:>6} {:>24} {:>12}".format("Stage", "Time", "Calls", "Throughput", "Peak")]
+    for name, stage in report["stages"].items():
+        lines.append("{:<12} {:>9.3f}s {:>6} {:>24} {:>12}".format(
+            name, stage["seconds"], stage["calls"],
+            "{:.0f} {}/s".format(stage["units_per_second"], stage["unit_name"]),
+            format_bytes(stage["peak_bytes"])))
+    lines.append("Total: {:.3f}s".format(report["total_seconds"]))
+    if notes:
+        for note, note_stages in report.get("notes", {}).items():
+            lines.append("{}: {}".format(note, ", ".join(
+                "{} {:.3f}s".format(name, stage["seconds"]) for name, stage in note_stages.items())))
+    return "\n".join(lines)
+
+# The profile goes next to the first output the tool was asked for.
+def profile_filename(args):
+    for output in ["instrument", "archive", "directory"]:
+        path = getattr(args, output, None)
+        if path:
+            return os.path.normpath(path) + ".prof"
+    return "profile.prof"
+
+# Runs a tool's run(args) with whatever --profile and --stats-json ask for.
+# cProfile and json are only loaded when one of them does.
+def run_with_metrics(run, args, **kwargs):
+    if not args.profile and not args.stats_json:
+        return run(args, **kwargs)
+    run_metrics = Metrics(track_memory=True)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        written_paths = run(args, stats=run_metrics, **kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+        run_metrics.close()
+    report = run_metrics.report()
+    if args.profile:
+        print(format_report(report))
+        profiler.dump_stats(profile_filename(args))
+        print("Wrote cProfile data to {}".format(profile_filename(args)))
+    if args.stats_json:
+        import json
+        output = io.open(args.stats_json, "w")
+        json.dump(report, output, indent=2)
+        output.close()
+    return written_paths
@@ -1,5 +1,3 @@
-import re
-
 frequency = [
     16.35, # C0
     17.32,
@@ -97,25 +95,79 @@ frequency = [
     3520,
     3729.3,
     3951.1,
+    4186.0, # C8, beyond the 2A03's useful range from here on
+    4434.9,
+    4698.6,
+    4978.0,
+    5274.0,
+    5587.7,
+    5919.9,
+    6271.9,
+    6644.9,
+    7040.0,
+    7458.6,
+    7902.1,
+    8372.0,
+    8869.8,
+    9397.3,
+    9956.1,
+    10548.1,
+    11175.3,
+    11839.8,
+    12543.9,
+    13289.8,
+    14080.0,
+    14917.2,
+    15804.3,
+    16744.0,
+    17739.7,
+    18794.5,
+    19912.1,
+    21096.2,
+    22350.6,
+    23679.6,
+    25087.7,
 ]
 
+letter_offsets = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+modifier_offsets = {'#': 1, 's': 1, 'b': -1}
+
 def _note_index(letter_name, octave_number, modifier):
-    letter_indices = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
-    modifiers = {'#': 1, 's': 1, 'b': -1}
-    note_index = letter_indices[letter_name.lower()]
+    note_index = letter_offsets[letter_name.lower()]
     octave_index = octave_number * 12
-    modifier_offset = modifiers.get(modifier.lower(), 0)
+    modifier_offset = modifier_offsets.get(modifier.lower(), 0)
     return octave_index + note_index + modifier_offset
 
+# Names for every index in the frequency table, as note_name writes them, and
+# the way back. Built once, so the common names never need parsing.
+note_names = [
+    ['C', 'Cs', 'D', 'Ds', 'E', 'F', 'Fs', 'G', 'Gs', 'A', 'As', 'B'][index % 12] + str(index // 12)
+    for index in range(0, len(frequency))]
+note_indices = {name: index for index, name in enumerate(note_names)}
+
+# Reads a letter, an optional sharp (# or s) or flat (b), and an octave number
+# from the start of the name. Anything after that is ignored.
 def note_index(note_name):
-    match = re.match(r'([A-Ga-g])([BbSs#]?)(\d+)', note_name)
-    if not match:
+    if note_name in note_indices:
+        return note_indices[note_name]
+    letter_name = note_name[0:1]
+    if letter_name == "" or letter_name.lower() not in letter_offsets:
+        raise Exception("Invalid note name")
+    modifier = note_name[1:2]
+    position = 2
+    if modifier == "" or modifier not in "BbSs#":
+        modifier = ""
+        position = 1
+    octave_end = position
+    while octave_end < len(note_name) and note_name[octave_end] in "0123456789":
+        octave_end += 1
+    if octave_end == position:
         raise Exception("Invalid note name")
-    letter_name, modifier, octave_str = match.groups()
-    octave_number = int(octave_str)
-    return _note_index(letter_name, octave_number, modifier)
+    return _note_index(letter_name, int(note_name[position:octave_end]), modifier)
 
 def note_name(midi_index):
+    if 0 <= midi_index < len(note_names):
+        return note_names[midi_index]
     letter_indices = ['C', 'Cs', 'D', 'Ds', 'E', 'F', 'Fs', 'G', 'Gs', 'A', 'As', 'B']
     letter = letter_indices[midi_index % 12]
     octave = str(int(midi_index / 12))
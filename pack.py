@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Single file archives of .dmc samples, so a large split or a full instrument's
+# worth of samples can be written (and later read back) without thousands of
+# tiny files. Two containers are supported, chosen by extension:
+#
+#   .zip:  an uncompressed zip, readable by any zip tool
+#   other: a pack file, laid out as
+#            "DPCMPACK", version (u16), sample count (u32)
+#            per sample: name length (u16), name (ascii), offset (u32), length (u32)
+#            sample data, back to back
+#          with every integer little endian, and offsets from the start of the file.
+#          Names whose data is identical share one offset, and the data is
+#          stored once.
+
+# python stdlib
+import argparse
+import io
+import os
+import struct
+
+PACK_MAGIC = b"DPCMPACK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<8sHI")
+PACK_NAME_LENGTH = struct.Struct("<H")
+PACK_LOCATION = struct.Struct("<II")
+
+def is_zip(filename):
+    return filename.lower().endswith(".zip")
+
+def pack_samples(samples):
+    names = [bytes(name, "ascii") for (name, data) in samples]
+    index_length = PACK_HEADER.size + sum(PACK_NAME_LENGTH.size + len(name) + PACK_LOCATION.size for name in names)
+    packed = bytearray(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(samples)))
+    offset = index_length
+    offsets = {}
+    stored = []
+    for name, (sample_name, data) in zip(names, samples):
+        key = bytes(data)
+        if key not in offsets:
+            offsets[key] = offset
+            stored.append(key)
+            offset += len(key)
+        packed += PACK_NAME_LENGTH.pack(len(name))
+        packed += name
+        packed += PACK_LOCATION.pack(offsets[key], len(key))
+    for data in stored:
+        packed += data
+    return bytes(packed)
+
+# samples is a list of (name, data) pairs. The whole archive is built in memory
+# and written with a single sequential write.
+def write_archive(filename, samples):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if is_zip(filename):
+        # zipfile is only loaded for .zip archives
+        import zipfile
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+            for (name, data) in samples:
+                # fixed timestamps, so the same samples always make the same archive
+                archive.writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), bytes(data))
+        contents = buffer.getvalue()
+    else:
+        contents = pack_samples(samples)
+    output = io.open(filename, "wb")
+    output.write(contents)
+    output.close()
+
+def read_pack_index(file):
+    header = file.read(PACK_HEADER.size)
+    if len(header) != PACK_HEADER.size:
+        raise Exception("Not a DPCM pack file")
+    (magic, version, count) = PACK_HEADER.unpack(header)
+    if magic != PACK_MAGIC:
+        raise Exception("Not a DPCM pack file")
+    if version != PACK_VERSION:
+        raise Exception("Unsupported DPCM pack version: {}".format(version))
+    index = {}
+    for i in range(0, count):
+        (name_length,) = PACK_NAME_LENGTH.unpack(file.read(PACK_NAME_LENGTH.size))
+        name = file.read(name_length).decode("ascii")
+        index[name] = PACK_LOCATION.unpack(file.read(PACK_LOCATION.size))
+    return index
+
+# Reads only the index up front; each sample is fetched on its own when asked for.
+class ArchiveReader:
+    def __init__(self, filename):
+        self.filename = filename
+        if is_zip(filename):
+            import zipfile
+            self.zip = zipfile.ZipFile(filename, "r")
+            self.file = None
+            self.index = None
+        else:
+            self.zip = None
+            self.file = io.open(filename, "rb")
+            self.index = read_pack_index(self.file)
+
+    def names(self):
+        if self.zip:
+            return self.zip.namelist()
+        return list(self.index.keys())
+
+    def read(self, name):
+        if self.zip:
+            return self.zip.read(name)
+        if name not in self.index:
+            raise KeyError(name)
+        (offset, length) = self.index[name]
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="List or extract the samples in a DPCM archive (.pack or .zip)",
+        formatter_class=argparse.RawDescriptionHelpFormatter,)
+    parser.add_argument("archive", help="Archive written with --archive")
+    parser.add_argument("names", nargs="*", help="Samples to extract (default: all)")
+    parser.add_argument("-s", "--directory", help="Extract samples into this directory. Without it, samples are only listed.")
+    args = parser.parse_args(argv)
+
+    with ArchiveReader(args.archive) as reader:
+        names = args.names or reader.names()
+        for name in names:
+            data = reader.read(name)
+            if args.directory:
+                sample_filename = os.path.join(args.directory, os.path.basename(name))
+                os.makedirs(args.directory, exist_ok=True)
+                output = io.open(sample_filename, "wb")
+                output.write(data)
+                output.close()
+            else:
+                print("{}: {} bytes".format(name, len(data)))
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
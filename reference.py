@@ -0,0 +1,173 @@
+# Frozen copies of the original pure Python engines, kept exactly as they were
+# first written so that faster production versions can be checked against them
+# (see equivalence.py). Do not change the behaviour of anything in here; if the
+# reference itself was wrong, fix the production engine and note it there.
+
+# python stdlib
+import collections
+import struct
+
+def patch_bytes(length_index):
+	return 16 * length_index + 1
+
+def patch_samples(length_index):
+	return patch_bytes(length_index) * 8
+
+def phase_offset(length_index, target_frequency, playback_rate):
+	patch_delta = patch_samples(length_index) / playback_rate
+	frequency_delta = 1 / target_frequency
+	return (patch_delta % frequency_delta) * target_frequency
+
+def tuning_error(length_index, target_frequency, playback_rate):
+    return 0.5 - abs(phase_offset(length_index, target_frequency, playback_rate) - 0.5)
+
+def repetitions(length_index, target_frequency, playback_rate):
+    samples = patch_samples(length_index)
+    return round(samples / (playback_rate / target_frequency), 0)
+
+def effective_frequency(length_index, repetitions, playback_rate):
+    samples = patch_samples(length_index)
+    return playback_rate / (samples / max(repetitions,1))
+
+def dpcm_level(pcm_sample):
+  #clamped_dpcm_level = int(max(0, min(127, pcm_sample / 2.0)))
+  #return clamped_dpcm_level
+  return pcm_sample / 2.0
+
+def pack_dpcm_bits_into_bytes(bit_array):
+  # pad the bit array out to one complete byte
+  while len(bit_array) % 8 != 0:
+    # oscillate the appended sample, so we don't move too far from the last position in the real data
+    bit_array.append(len(bit_array) % 2)
+  # here go from list -> deque, which has MUCH faster pop performance
+  bit_array = collections.deque(bit_array)
+  byte_array = []
+  while len(bit_array) > 0:
+    byte_value = 0
+    for i in range(0,8):
+      byte_value += bit_array.popleft() << i
+    byte_array.append(byte_value)
+  return bytes(byte_array)
+
+def unpack_bytes_into_bits(byte_array):
+  bit_array = []
+  while len(byte_array) > 0:
+    byte_value = byte_array.pop(0)
+    for i in range(0,8):
+      bit_array.append((byte_value & (1 << i)) >> i)
+  return bit_array
+
+def to_dpcm(pcm_samples, starting_level=None):
+  current_dpcm_level = dpcm_level(pcm_samples[0])
+  if starting_level != None:
+    current_dpcm_level = starting_level
+  dpcm_levels = map(dpcm_level, pcm_samples)
+  dpcm_bits = []
+  for target_level in dpcm_levels:
+    if target_level > current_dpcm_level:
+      dpcm_bits.append(1)
+      current_dpcm_level += 2
+    else:
+      dpcm_bits.append(0)
+      current_dpcm_level -= 2
+  return pack_dpcm_bits_into_bytes(dpcm_bits)
+
+def bias(dpcm_bytes):
+  bit_array = unpack_bytes_into_bits(list(dpcm_bytes))
+  current_dpcm_level = 0 # signed, also we don't care about range for this
+  while len(bit_array) > 0:
+    sample = bit_array.pop(0)
+    if sample == 1:
+      current_dpcm_level += 2
+    else:
+      current_dpcm_level -= 2
+  return current_dpcm_level
+
+# from looper.py
+
+def _tuning_error(a):
+    return a["error"]
+
+# (the only change from the original: it called dpcm.repetitions, which here
+# would be shadowed by the local of the same name)
+def ideal_tunings(target_frequency, playback_rate, max_length):
+    tunings = []
+    for i in range(1,max_length):
+        repetition_count = repetitions(i, target_frequency, playback_rate)
+        tuning = {
+            "phase_offset": phase_offset(i, target_frequency, playback_rate),
+            "error": tuning_error(i, target_frequency, playback_rate),
+            "length": i,
+            "size": patch_bytes(i),
+            "samples": patch_samples(i),
+            "repetitions": repetition_count,
+            "effective_frequency": effective_frequency(i, repetition_count, playback_rate),
+        }
+        tunings.append(tuning)
+    tunings.sort(key=_tuning_error)
+    return tunings
+
+# from fti.py
+
+INST_HEADER = "FTI"
+INST_VERSION = "2.4"
+INST_2A03 = 1
+
+def write_char(file, value):
+  file.write(struct.pack("b", value))
+
+def write_uchar(file, value):
+  file.write(struct.pack("B", value))
+
+def write_int(file, value):
+  file.write(struct.pack("i", value))
+
+def write_string(file, str):
+  file.write(bytes(str, "ascii"))
+
+def write_instrument_header(file, name):
+  assert(len(name) < 128)
+  write_string(file, INST_HEADER)
+  write_string(file, INST_VERSION)
+  write_char(file, INST_2A03)
+  write_int(file, len(name))
+  write_string(file, name)
+
+# We're creating a DPCM instrument, so the
+# sequence data is not useful; blank it out for
+# this purpose.
+def write_empty_sequence_data(file):
+  write_char(file, 0) # zero sequences
+
+def write_sample_attributes(file, note_index, sample_index, dpcm_pitch, looping=False, delta=-1):
+  pitch_byte = dpcm_pitch & 0xF
+  if looping:
+    pitch_byte |= 0x80
+
+  write_char(file, note_index)
+  write_char(file, sample_index)
+  write_uchar(file, pitch_byte)
+  write_char(file, delta)
+
+def midi_to_note_index(midi_index):
+  note_index = midi_index - 12
+  assert(note_index >= 0 and note_index < 127)
+  return note_index
+
+def write_sample_data(file, name, raw_data):
+  write_int(file, len(name))
+  write_string(file, name)
+  write_int(file, len(raw_data))
+  file.write(bytes(raw_data))
+
+def write_dpcm_instrument(file, instrument_name, note_mappings, samples):
+  write_instrument_header(file, instrument_name)
+  write_empty_sequence_data(file)
+  write_int(file, len(note_mappings))
+  for note_mapping in note_mappings:
+    write_sample_attributes(file, midi_to_note_index(note_mapping["midi_index"]), note_mapping["sample_index"], note_mapping["pitch"], note_mapping["looping"], note_mapping["delta"])
+  write_int(file, len(samples))
+  for sample_index in range(0, len(samples)):
+    sample = samples[sample_index]
+    write_int(file, sample_index)
+    write_sample_data(file, sample["name"], sample["data"])
@@ -2,7 +2,9 @@
 
 import dpcm
 import fti
+import metrics
 import midi
+import pack
 
 # python stdlib
 import argparse
@@ -10,6 +12,7 @@ import os
 import io
 import wave
 import struct
+import time
 
 def mix_stereo_to_mono(combined_stereo_frames):
     mono_frames = []
@@ -66,7 +69,9 @@ def resample_note(source_data, source_samplerate, target_samplerate, source_freq
     resampled_data = resampler(source_data, combined_speed)
     return resampled_data
 
-def generate_repitched_instrument(source_data, source_samplerate, source_note, target_notes, target_quality=0xF, max_length=4081, prefix=None, set_delta=-1,):
+def generate_repitched_instrument(source_data, source_samplerate, source_note, target_notes, target_quality=0xF, max_length=4081, prefix=None, set_delta=-1,
+        encoder=dpcm.to_dpcm, compare_encoders=False, stats=None):
+    stats = stats or metrics.Metrics()
     note_mappings = []
     sample_table = []
     sample_prefix = ""
@@ -79,12 +84,19 @@ def generate_repitched_instrument(source_data, source_samplerate, source_note, t
         sample_prefix = prefix + "-"
 
     for target_note in note_list:
+        sample_name = midi.note_name(target_note)
         target_frequency = midi.frequency[target_note]
-        resampled_pcm = resample_note(source_data, source_samplerate, target_rate, source_frequency, target_frequency)
+        with stats.stage("resampling", unit_name="samples", note=sample_name) as record:
+            resampled_pcm = resample_note(source_data, source_samplerate, target_rate, source_frequency, target_frequency)
+            record.units = len(resampled_pcm)
         if len(resampled_pcm) > max_length * 8:
             resampled_pcm = resampled_pcm[0:(max_length*8)]
-        dpcm_data = dpcm.to_dpcm(resampled_pcm)
-        sample_name = midi.note_name(target_note)
+        with stats.stage("encoding", units=len(resampled_pcm), unit_name="samples", note=sample_name):
+            start_time = time.perf_counter()
+            dpcm_data = encoder(resampled_pcm)
+            encoding_seconds = time.perf_counter() - start_time
+        if compare_encoders:
+            print("{}: {}".format(sample_name, dpcm.format_comparison(dpcm.compare_encoders(resampled_pcm, dpcm_data, encoding_seconds))))
         sample_table.append({"name": sample_prefix+sample_name, "data": dpcm_data})
         note_mappings.append({"midi_index": target_note + 12, "sample_index": sample_index, "pitch": target_quality, "looping": False, "delta": set_delta})
         sample_index += 1
@@ -96,12 +108,15 @@ def sample_prefix(args):
     if args.instrument:
         (nicename, ext) = os.path.splitext(os.path.basename(args.instrument))
         return nicename
+    if args.archive:
+        (nicename, ext) = os.path.splitext(os.path.basename(args.archive))
+        return nicename
     if args.directory:
         (head, tail) = os.path.split(args.directory)
         return tail
     return None
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Generate melodic DPCM from a single source sample", 
         formatter_class=argparse.RawDescriptionHelpFormatter,)
@@ -109,12 +124,19 @@ def main():
     parser.add_argument("notes", help="Notes to generate. Ex: gs2,f3-a3")
     parser.add_argument("-r", "--reference", help="Reference note for the source waveform, used for repitching. (default: C4)", default="C4")
     parser.add_argument("-i", "--instrument", help="FamiTracker instrument filename to generate")
+    parser.add_argument("-a", "--archive", help="Store generated samples in one .pack (or .zip) archive")
     parser.add_argument("--prefix", help="Samples will be named [prefix]-[note] (default: filename)")
 
     generator_group = parser.add_argument_group("Sample Generation")
     generator_group.add_argument("-l", "--max-length", help="Samples longer than this will be truncated. Values larger than 4081 are invalid. (default: 4081)", type=int, default=4081)
     generator_group.add_argument("-q", "--quality", help="DPCM playback rate, ranging from 0 - 15. (default: 15)", type=int, default=15)
 
+    encoder_group = parser.add_argument_group("DPCM Encoding")
+    encoder_group.add_argument("--encoder", help="One of: {} (default: greedy)".format(", ".join(dpcm.encoder_names)),
+        choices=dpcm.encoder_names, default="greedy")
+    encoder_group.add_argument("--lookahead", help="Trellis window in samples, 0 for the whole sample. Bounds memory on long inputs, but encodes more slowly. (default: 0)", type=dpcm.lookahead_length, default=0)
+    encoder_group.add_argument("--compare-encoders", dest="compare_encoders", help="Report error and speed against the greedy encoder", action='store_true')
+
     instrument_group = parser.add_argument_group("FamiTracker Instruments")
     instrument_group.add_argument("-d", "--delta", help="Set the delta counter when playback begins", type=int, default=-1)
     instrument_group.add_argument("--repitch", dest="repitch", help="Fill out an instrument's lower range with repitched samples (default: True)", action='store_true')
@@ -122,25 +144,55 @@ def main():
     instrument_group.add_argument("--fullname", help="The full name of this instrument, show in FamiTracker's UI")
     instrument_group.set_defaults(repitch=True)
 
-    args = parser.parse_args()
-
-    data, samplerate = read_wave(args.source)
+    profile_group = parser.add_argument_group("Profiling")
+    profile_group.add_argument("--profile", help="Report time, throughput and peak memory per stage and note, and save a cProfile dump next to the output", action='store_true')
+    profile_group.add_argument("--stats-json", dest="stats_json", help="Write the per-stage report to this JSON file")
+    return parser
+
+# Generates and writes everything asked for by parsed command line arguments,
+# and returns the paths written. The source may be passed in as already read by
+# read_wave, to share it between runs, as may a Metrics.
+def run(args, source=None, stats=None):
+    stats = stats or metrics.Metrics()
+    if source == None:
+        with stats.stage("ingest", unit_name="frames") as record:
+            source = read_wave(args.source)
+            record.units = len(source[0])
+    data, samplerate = source
     print("Read {} samples from {} at {} Hz".format(len(data), args.source, samplerate))
 
     (sample_table, note_mappings) = generate_repitched_instrument(data, samplerate, args.reference, args.notes, target_quality=args.quality, 
-        set_delta=args.delta, max_length=args.max_length, prefix=sample_prefix(args))
+        set_delta=args.delta, max_length=args.max_length, prefix=sample_prefix(args),
+        encoder=dpcm.encoder(args.encoder, args.lookahead), compare_encoders=args.compare_encoders,
+        stats=stats)
 
+    written_paths = []
     if args.instrument:
         instrument_filename = args.instrument
         (nicename, ext) = os.path.splitext(os.path.basename(instrument_filename))
         full_instrument_name = args.fullname or "DPCM {}".format(nicename)
 
-        note_mappings = fti.fill_lower_samples(note_mappings)
-        output = io.open(args.instrument, "wb")
-        fti.write_dpcm_instrument(output, full_instrument_name, note_mappings, sample_table)
-        output.close()
-    else:
-        print("Sorry, only instrument generation supported at the moment.")
+        with stats.stage("packing", unit_name="bytes") as record:
+            note_mappings = fti.fill_lower_samples(note_mappings)
+            instrument = io.BytesIO()
+            fti.write_dpcm_instrument(instrument, full_instrument_name, note_mappings, sample_table)
+            record.units = len(instrument.getvalue())
+        with stats.stage("write", units=len(instrument.getvalue()), unit_name="bytes"):
+            output = io.open(args.instrument, "wb")
+            output.write(instrument.getvalue())
+            output.close()
+        written_paths.append(args.instrument)
+    if args.archive:
+        with stats.stage("write", units=sum(len(sample["data"]) for sample in sample_table), unit_name="bytes"):
+            pack.write_archive(args.archive, [(sample["name"] + ".dmc", sample["data"]) for sample in sample_table])
+        written_paths.append(args.archive)
+    if not args.instrument and not args.archive:
+        print("Sorry, only instrument and archive generation supported at the moment.")
+    return written_paths
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.run_with_metrics(run, args)
 
 
 
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import batch
+
+# python stdlib
+import argparse
+import base64
+import http.server
+import io
+import json
+import os
+import queue
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+# The tools report progress with print(), and several requests may be running at
+# once, so stdout is swapped (once) for a proxy which sends each thread's output
+# to that thread's own log, if it has one.
+class ThreadLogs(io.TextIOBase):
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        log = getattr(self.local, "log", None)
+        if log != None:
+            return log.write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Work:
+    def __init__(self, job):
+        self.job = job
+        self.done = threading.Event()
+        self.written_paths = []
+        self.error = None
+        self.log = ""
+        self.seconds = 0.0
+
+# A fixed number of worker threads behind a bounded queue. Once the queue is
+# full, new requests are turned away instead of piling up.
+class WorkerPool:
+    def __init__(self, workers, queue_size, logs):
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.logs = logs
+        self.workers = workers
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+
+    def submit(self, work):
+        try:
+            self.pending.put_nowait(work)
+        except queue.Full:
+            raise RequestError(503, "Too many requests queued, try again shortly")
+
+    def work(self):
+        while True:
+            work = self.pending.get()
+            log = io.StringIO()
+            self.logs.local.log = log
+            start_time = time.perf_counter()
+            try:
+                work.written_paths = batch.execute_job(work.job)
+            except SystemExit as e:
+                work.error = str(e.code)
+            except Exception as e:
+                work.error = "{}: {}".format(type(e).__name__, e)
+            self.logs.local.log = None
+            work.seconds = time.perf_counter() - start_time
+            work.log = log.getvalue()
+            work.done.set()
+            self.pending.task_done()
+
+# Turns a request body into a batch job. Outputs are always written into a
+# scratch directory owned by the request, so clients never name server-side paths.
+def build_job(tool, request, directory):
+    if tool not in batch.tools:
+        raise RequestError(404, "Unknown tool: {}".format(tool))
+    name = str(request.get("name", tool))
+    if os.path.basename(name) != name or name in ["", ".", ".."]:
+        raise RequestError(400, "Invalid name: {}".format(name))
+    argv = [str(x) for x in request.get("args", [])]
+    # the client's own arguments may not pick outputs of their own
+    try:
+        client_args = batch.tools[tool].build_parser().parse_args(argv)
+    except SystemExit:
+        raise RequestError(400, "Invalid arguments for {}: {}".format(tool, " ".join(argv)))
+    for option, flags in [
+        ("instrument", "-i/--instrument"),
+        ("directory", "-s/--directory"),
+        ("archive", "-a/--archive"),
+        ("profile", "--profile"),
+        ("stats_json", "--stats-json")]:
+        if getattr(client_args, option, None):
+            raise RequestError(400, "args may not include {}, the server decides what is written (see \"outputs\")".format(flags))
+    outputs = request.get("outputs", ["instrument"])
+    if "instrument" in outputs:
+        argv += ["-i", os.path.join(directory, name + ".fti")]
+    if "samples" in outputs:
+        if tool == "repitcher":
+            raise RequestError(400, "repitcher can only write instruments")
+        argv += ["-s", os.path.join(directory, name)]
+    if "archive" in outputs:
+        argv += ["-a", os.path.join(directory, name + ".pack")]
+    try:
+        args = batch.tools[tool].build_parser().parse_args(argv)
+    except SystemExit:
+        raise RequestError(400, "Invalid arguments for {}: {}".format(tool, " ".join(argv)))
+    return {"index": 0, "name": name, "tool": tool, "args": args}
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"status": "error", "error": "Not found"})
+            return
+        self.send_json(200, {
+            "status": "ok",
+            "workers": self.server.pool.workers,
+            "queued": self.server.pool.pending.qsize(),
+            "tuning_tables": len(batch._tuning_tables),
+            "sources": len(batch._sources),
+            "wave_generators": len(batch._wave_generators),
+        })
+
+    def do_POST(self):
+        tool = self.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                raise RequestError(400, "Request body is not valid JSON")
+            with tempfile.TemporaryDirectory(prefix="dpcm-") as directory:
+                work = Work(build_job(tool, request, directory))
+                self.server.pool.submit(work)
+                work.done.wait()
+                if work.error:
+                    self.send_json(500, {"status": "error", "error": work.error, "log": work.log})
+                    return
+                files = []
+                scratch = os.path.realpath(directory)
+                for path in work.written_paths:
+                    if os.path.commonpath([scratch, os.path.realpath(path)]) != scratch:
+                        raise RequestError(500, "Refusing to return a file outside the request's directory: {}".format(path))
+                    with io.open(path, "rb") as output:
+                        files.append({
+                            "name": os.path.relpath(path, directory),
+                            "data": base64.b64encode(output.read()).decode("ascii"),
+                        })
+            self.send_json(200, {"status": "ok", "files": files, "log": work.log, "seconds": work.seconds})
+        except RequestError as e:
+            self.send_json(e.status, {"status": "error", "error": str(e)})
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+def main(argv=None):
+    examples = """
+    Requests:
+      POST /looper, /repitcher or /splitter with a JSON body:
+        {"name": "tri", "args": ["-g", "triangle", "-v", "0.5", "c4"], "outputs": ["instrument", "samples"]}
+      "args" are the tool's own command line arguments, without -i, -s, -a,
+      --profile or --stats-json (requests with them are refused).
+      "outputs" may hold any of "instrument", "samples" and "archive".
+      The reply lists every file written, base64 encoded, along with the tool's output.
+
+      GET /status reports the queue and what is being kept warm.
+
+    Example:
+      %(prog)s --unix /tmp/dpcm.sock
+      curl --unix-socket /tmp/dpcm.sock -d '{"args": ["c4"]}' http://localhost/looper
+    """
+    parser = argparse.ArgumentParser(
+        description="Keep DPCM generation warm, and serve it over a local socket",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=examples)
+    parser.add_argument("-p", "--port", help="Listen for HTTP on this localhost port (default: 8337)", type=int, default=8337)
+    parser.add_argument("--unix", help="Listen on this Unix socket instead")
+    parser.add_argument("-j", "--workers", help="Number of worker threads (default: 2)", type=int, default=2)
+    parser.add_argument("-q", "--queue-size", help="Requests allowed to wait for a worker before new ones are refused (default: 16)", type=int, default=16)
+    parser.add_argument("--verbose", help="Log every request", action='store_true')
+    args = parser.parse_args(argv)
+
+    logs = ThreadLogs(sys.stdout)
+    sys.stdout = logs
+
+    # the looper's default rate and length are by far the most common, so have them ready
+    print("Warming tuning table for rate $F...")
+    batch.build_tunings(0xF, 255, range(0, 94))
+
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = UnixServer(args.unix, RequestHandler)
+        print("Listening on {}".format(args.unix))
+    else:
+        server = Server(("127.0.0.1", args.port), RequestHandler)
+        print("Listening on http://127.0.0.1:{}".format(args.port))
+    server.pool = WorkerPool(args.workers, args.queue_size, logs)
+    server.verbose = args.verbose
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
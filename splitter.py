@@ -2,6 +2,8 @@
 
 import dpcm
 import fti
+import metrics
+import pack
 
 import argparse
 import math
@@ -9,6 +11,7 @@ import os
 import io
 import wave
 import struct
+import time
 
 def mix_stereo_to_mono(combined_stereo_frames):
     mono_frames = []
@@ -42,16 +45,94 @@ def read_wave(filename):
     data = fix_sample_width(data, sample_width)
     return data, samplerate
 
+# Chunks start every split_length bytes, but each runs on for chunk_length bytes,
+# overlapping the start of the next one.
+def split_chunks(dpcm_bytes, split_length, chunk_length):
+    dpcm_chunks = []
+    while len(dpcm_bytes) > 0:
+        chunk = bytearray(dpcm_bytes[0:chunk_length])
+        dpcm_bytes = dpcm_bytes[split_length:]
+        # if we don't pad to the full length famitracker will complain, so do that
+        # (in practice we'll rarely use the last chunk)
+        if len(chunk) != chunk_length:
+            chunk.extend([0]*chunk_length)
+            chunk = chunk[:chunk_length]
+        dpcm_chunks.append(chunk)
+    return dpcm_chunks
+
+# FamiTracker keeps at most 64 samples per module, and an instrument maps 8 octaves
+MAX_SAMPLES = 64
+MAX_NOTES = 96
+
+# For each byte value, how far its eight deltas carry the level: (net, lowest,
+# highest), relative to the level before the byte. Lets a chunk be measured a
+# byte at a time rather than a bit at a time.
+def byte_excursions():
+    excursions = []
+    for byte_value in range(0, 256):
+        level = lowest = highest = 0
+        for bit in range(0, 8):
+            level += 2 if byte_value & (1 << bit) else -2
+            lowest = min(lowest, level)
+            highest = max(highest, level)
+        excursions.append((level, lowest, highest))
+    return excursions
+
+excursion_table = byte_excursions()
+
+# The distance between the lowest and highest delta counter level a chunk
+# reaches. A flat signal toggles, which covers 2.
+def peak_to_peak(dpcm_bytes):
+    level = lowest = highest = 0
+    for byte_value in dpcm_bytes:
+        (net, byte_lowest, byte_highest) = excursion_table[byte_value]
+        lowest = min(lowest, level + byte_lowest)
+        highest = max(highest, level + byte_highest)
+        level += net
+    return highest - lowest
+
+# Finds chunks which are silent, or byte-identical to an earlier chunk, so they
+# can share one stored sample. Returns the distinct samples as (label, data) in
+# order of first use, and for every chunk the index of the sample that plays it.
+# Silent chunks all share one balanced sample which leaves the level alone.
+def alias_chunks(chunks, silence_threshold=4):
+    samples = []
+    sample_indices = []
+    seen = {}
+    for i in range(0, len(chunks)):
+        chunk = chunks[i]
+        label = f"{i:03d}"
+        if peak_to_peak(chunk) <= silence_threshold:
+            chunk = bytearray([0x55] * len(chunk))
+            label = "silence"
+        key = bytes(chunk)
+        if key not in seen:
+            seen[key] = len(samples)
+            samples.append((label, chunk))
+        sample_indices.append(seen[key])
+    return samples, sample_indices
+
+# Keeps the leading chunks which fit in one instrument: no more notes than it
+# can map, and no more samples than a module can hold.
+def fit_instrument(samples, sample_indices):
+    note_count = 0
+    while note_count < min(len(sample_indices), MAX_NOTES) and sample_indices[note_count] < MAX_SAMPLES:
+        note_count += 1
+    sample_indices = sample_indices[0:note_count]
+    return samples[0:max(sample_indices, default=-1) + 1], sample_indices
+
 # because doing this by hand in famitracker's UI is AWFUL on Wine
-def compile_instrument(file, instrument_name, chunks):
+def compile_instrument(file, instrument_name, samples, sample_indices):
     sample_table = []
     note_mappings = []
-    for i in range(0, len(chunks)):
-        sample_table.append({"name": f"{instrument_name}_{i:03d}", "data": chunks[i]})
-        note_mappings.append({"midi_index": i+12, "sample_index": i, "pitch": 0xF, "looping": False, "delta": 0})
+    for (label, data) in samples:
+        sample_table.append({"name": f"{instrument_name}_{label}", "data": data})
+    for i in range(0, len(sample_indices)):
+        # note maps count samples from 1, 0 being no sample at all
+        note_mappings.append({"midi_index": i+12, "sample_index": sample_indices[i] + 1, "pitch": 0xF, "looping": False, "delta": 0})
     fti.write_dpcm_instrument(file, instrument_name, note_mappings, sample_table)
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Split a long .wav into many smaller .dmc samples", 
         formatter_class=argparse.RawDescriptionHelpFormatter,)
@@ -59,11 +140,30 @@ def main():
     parser.add_argument("length", help="Split length in seconds")
     parser.add_argument("-s", "--directory", help="Directory to store generated samples as .dmc")
     parser.add_argument("-i", "--instrument", help="DnFamiTracker Instrument to write, as .fti")
+    parser.add_argument("-a", "--archive", help="Store all chunks in one .pack (or .zip) archive instead of a directory")
+
+    parser.add_argument("--silence", help="Chunks whose level spans no more than this are silent, and share one sample. 0 to disable. (default: 4)", type=int, default=4)
+    parser.add_argument("--keep-duplicates", dest="keep_duplicates", help="Store every chunk, even silent or repeated ones", action='store_true')
+
+    encoder_group = parser.add_argument_group("DPCM Encoding")
+    encoder_group.add_argument("--encoder", help="One of: {} (default: greedy)".format(", ".join(dpcm.encoder_names)),
+        choices=dpcm.encoder_names, default="greedy")
+    encoder_group.add_argument("--lookahead", help="Trellis window in samples, 0 for the whole file. Bounds memory on long inputs, but encodes more slowly. (default: 8192)", type=dpcm.lookahead_length, default=8192)
+    encoder_group.add_argument("--compare-encoders", dest="compare_encoders", help="Report error and speed against the greedy encoder", action='store_true')
 
     instrument_group = parser.add_argument_group("FamiTracker Instruments")
     instrument_group.add_argument("--fullname", help="The full name of this instrument, show in FamiTracker's UI")
 
-    args = parser.parse_args()
+    profile_group = parser.add_argument_group("Profiling")
+    profile_group.add_argument("--profile", help="Report time, throughput and peak memory per stage, and save a cProfile dump next to the output", action='store_true')
+    profile_group.add_argument("--stats-json", dest="stats_json", help="Write the per-stage report to this JSON file")
+    return parser
+
+# Splits and writes everything asked for by parsed command line arguments, and
+# returns the paths written. The source may be passed in as already read by
+# read_wave, to share it between runs, as may a Metrics.
+def run(args, source=None, stats=None):
+    stats = stats or metrics.Metrics()
     length_in_seconds = float(args.length)
     length_in_dpcm_samples = length_in_seconds * dpcm.playback_rate[0xF]
     split_length_in_dpcm_bytes = math.floor(length_in_dpcm_samples / 8)
@@ -72,45 +172,79 @@ def main():
     print(f"Split length will be at {split_length_in_dpcm_bytes} byte boundaries")
     print(f"Sample length will be {actual_split_duration}, including ~16ms extra length each")
 
-    data, samplerate = read_wave(args.source)
+    if source == None:
+        with stats.stage("ingest", unit_name="frames") as record:
+            source = read_wave(args.source)
+            record.units = len(source[0])
+    data, samplerate = source
     print("Read {} samples from {} at {} Hz".format(len(data), args.source, samplerate))
 
     print("Performing conversion (may take a minute)...")
-    dpcm_bytes = dpcm.to_dpcm(data)
+    encoder = dpcm.encoder(args.encoder, args.lookahead)
+    with stats.stage("encoding", units=len(data), unit_name="samples"):
+        start_time = time.perf_counter()
+        dpcm_bytes = encoder(data)
+        encoding_seconds = time.perf_counter() - start_time
+    if args.compare_encoders:
+        print(dpcm.format_comparison(dpcm.compare_encoders(data, dpcm_bytes, encoding_seconds)))
 
     print("Splitting converted bytes along chunk boundaries...")
-    dpcm_chunks = []
-    while len(dpcm_bytes) > 0:
-        chunk = bytearray(dpcm_bytes[0:actual_split_duration])
-        dpcm_bytes = dpcm_bytes[split_length_in_dpcm_bytes:]
-        # if we don't pad to the full length famitracker will complain, so do that
-        # (in practice we'll rarely use the last chunk)
-        if len(chunk) != actual_split_duration:
-            chunk.extend([0]*actual_split_duration)
-            chunk = chunk[:actual_split_duration]
-        dpcm_chunks.append(chunk)
-
-    print(f"After conversion, got {len(dpcm_chunks)} chunks in total, will proceed to output...")    
-
+    with stats.stage("packing", units=len(dpcm_bytes), unit_name="bytes"):
+        dpcm_chunks = split_chunks(dpcm_bytes, split_length_in_dpcm_bytes, actual_split_duration)
+
+    print(f"After conversion, got {len(dpcm_chunks)} chunks in total, will proceed to output...")
+
+    if args.keep_duplicates:
+        samples = [(f"{i:03d}", dpcm_chunks[i]) for i in range(0, len(dpcm_chunks))]
+        sample_indices = list(range(0, len(dpcm_chunks)))
+    else:
+        with stats.stage("aliasing", units=len(dpcm_chunks), unit_name="chunks"):
+            samples, sample_indices = alias_chunks(dpcm_chunks, args.silence)
+        silent = sum(1 for i in range(0, len(sample_indices)) if samples[sample_indices[i]][0] == "silence")
+        repeated = len(dpcm_chunks) - silent - sum(1 for (label, data) in samples if label != "silence")
+        print(f"{silent} silent and {repeated} repeated chunks share samples, leaving {len(samples)} to store")
+
+    # every chunk keeps its own name, in song order, holding the sample that
+    # plays it; a .pack stores each shared sample once, under all its names
+    named_chunks = [(f"thing_{i:03d}.dmc", samples[sample_indices[i]][1]) for i in range(0, len(sample_indices))]
+    written_paths = []
+    chunk_bytes = sum(len(data) for (name, data) in named_chunks)
     if args.directory != None:
-        for i in range(0, len(dpcm_chunks)):
-            chunk_data = dpcm_chunks[i]
-
-            chunk_filename = f"{args.directory}/thing_{i:03d}.dmc"
-
-            os.makedirs(args.directory, exist_ok=True)
-            output = io.open(chunk_filename, "wb")
-            output.write(chunk_data)
-            output.close()
+        with stats.stage("write", units=chunk_bytes, unit_name="bytes"):
+            for (name, data) in named_chunks:
+                chunk_filename = f"{args.directory}/{name}"
+
+                os.makedirs(args.directory, exist_ok=True)
+                output = io.open(chunk_filename, "wb")
+                output.write(data)
+                output.close()
+                written_paths.append(chunk_filename)
+    if args.archive != None:
+        with stats.stage("write", units=chunk_bytes, unit_name="bytes"):
+            pack.write_archive(args.archive, named_chunks)
+        written_paths.append(args.archive)
     if args.instrument != None:
         instrument_filename = args.instrument
         (nicename, ext) = os.path.splitext(os.path.basename(instrument_filename))
         full_instrument_name = args.fullname or "DPCM {}".format(nicename)
 
-        output = io.open(instrument_filename, "wb")
-        truncated_chunks = dpcm_chunks[0:64]
-        compile_instrument(output, full_instrument_name, truncated_chunks)
-        output.close()
+        with stats.stage("packing", unit_name="bytes") as record:
+            instrument = io.BytesIO()
+            (instrument_samples, instrument_indices) = fit_instrument(samples, sample_indices)
+            if len(instrument_indices) < len(sample_indices):
+                print(f"Instrument holds the first {len(instrument_indices)} chunks, in {len(instrument_samples)} samples")
+            compile_instrument(instrument, full_instrument_name, instrument_samples, instrument_indices)
+            record.units = len(instrument.getvalue())
+        with stats.stage("write", units=len(instrument.getvalue()), unit_name="bytes"):
+            output = io.open(instrument_filename, "wb")
+            output.write(instrument.getvalue())
+            output.close()
+        written_paths.append(instrument_filename)
+    return written_paths
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    metrics.run_with_metrics(run, args)
 
 if __name__ == "__main__":
     # execute only if run as a script
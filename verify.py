@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Checks the tuning and quality of generated instruments by decoding every
+# sample the way the hardware plays it, measuring the fundamental, and comparing
+# it with the note each mapping claims to play. Given what the instrument was
+# generated from, the decoded samples are also compared with that to give an SNR.
+
+import dpcm
+import fti
+import looper
+import midi
+import pack
+import repitcher
+import waveform
+
+# python stdlib
+import argparse
+import cmath
+import io
+import json
+import math
+import os
+import re
+
+DEFAULT_WINDOW = 8192
+MIN_WINDOW = 2048
+UPSAMPLED_PERIOD = 32
+DECIMATED_PERIOD = 64
+MAX_UPSAMPLED_SIZE = 8192
+
+# bit reversed order and twiddle factors, built once per transform size
+_fft_tables = {}
+
+def _fft_table(size):
+    if size not in _fft_tables:
+        bits = size.bit_length() - 1
+        order = [int(format(i, "0{}b".format(bits))[::-1], 2) if bits > 0 else 0 for i in range(0, size)]
+        twiddles = [cmath.exp(-2j * math.pi * k / size) for k in range(0, size // 2)]
+        _fft_tables[size] = (order, twiddles)
+    return _fft_tables[size]
+
+# Iterative radix-2 FFT of a power of two length list of complex values. Each
+# stage's butterflies are done a slice at a time with list comprehensions:
+# across every block at once for one twiddle factor while blocks are many, and
+# then a block at a time once they are few, which keeps the Python level loop
+# short at every stage. The inverse is left unscaled.
+def fft(values, inverse=False):
+    size = len(values)
+    (order, twiddles) = _fft_table(size)
+    result = [values[i] for i in order]
+    span = 2
+    while span <= size:
+        half = span // 2
+        factors = twiddles[0:size // 2:size // span]
+        if inverse:
+            factors = [factor.conjugate() for factor in factors]
+        if half < size // span:
+            for k in range(0, half):
+                factor = factors[k]
+                low = result[k::span]
+                high = [value * factor for value in result[k + half::span]]
+                result[k::span] = [a + b for a, b in zip(low, high)]
+                result[k + half::span] = [a - b for a, b in zip(low, high)]
+        else:
+            for start in range(0, size, span):
+                middle = start + half
+                end = start + span
+                low = result[start:middle]
+                high = [value * factor for value, factor in zip(result[middle:end], factors)]
+                result[start:middle] = [a + b for a, b in zip(low, high)]
+                result[middle:end] = [a - b for a, b in zip(low, high)]
+        span *= 2
+    return result
+
+def next_power_of_two(value):
+    size = 1
+    while size < value:
+        size *= 2
+    return size
+
+# Autocorrelations of two equal length real signals from one complex transform
+# each way: x goes in the real part and y in the imaginary part, their spectra
+# are separated using conjugate symmetry, and the two power spectra go back
+# through a single inverse transform as real and imaginary parts again. With an
+# upsample factor the power spectra are zero padded first, which interpolates
+# the correlations to that many points per lag.
+def paired_autocorrelation(x, y, upsample=1):
+    size = next_power_of_two(2 * len(x))
+    combined = [complex(a, b) for a, b in zip(x, y)]
+    combined.extend([0j] * (size - len(combined)))
+    spectrum = fft(combined)
+    mirrors = [spectrum[0].conjugate()] + [z.conjugate() for z in reversed(spectrum[1:])]
+    powers = [complex(abs(z + mirror) ** 2 / 4, abs(z - mirror) ** 2 / 4) for z, mirror in zip(spectrum, mirrors)]
+    if upsample > 1:
+        # split the Nyquist bin between both ends, so the result stays real
+        half = size // 2
+        powers[half] /= 2
+        powers = powers[0:half + 1] + [0j] * (size * (upsample - 1) - 1) + powers[half:]
+    correlation = fft(powers, inverse=True)
+    count = len(x) * upsample
+    return [value.real / size for value in correlation[0:count]], [value.imag / size for value in correlation[0:count]]
+
+# The period, in samples, from an autocorrelation with upsample points per lag:
+# the first peak that comes close to the strongest one, which avoids locking
+# onto a multiple of the period, refined with a parabola through its
+# neighbours and then against multiples of it. Peaks before the correlation
+# first goes negative are the encoder's own +2/-2 chatter, and are skipped.
+# None for silence or when there is no peak at all.
+def estimate_period(correlation, upsample=1):
+    window = len(correlation)
+    if correlation[0] <= 0:
+        return None
+    # undo the taper that zero padding puts on longer lags
+    normalized = [correlation[lag] / correlation[0] * window / (window - lag) for lag in range(0, window // 2 + 2)]
+    first_negative = next((lag for lag in range(1, len(normalized)) if normalized[lag] < 0), None)
+    if first_negative == None:
+        return None
+    peaks = []
+    for lag in range(first_negative + 1, len(normalized) - 1):
+        before, at, after = normalized[lag - 1], normalized[lag], normalized[lag + 1]
+        if at > 0 and at >= before and at > after:
+            curvature = before - 2 * at + after
+            peaks.append((lag + (0.5 * (before - after) / curvature if curvature != 0 else 0.0), at))
+    if not peaks:
+        return None
+    strongest = max(height for lag, height in peaks)
+    (period, period_height) = next(peak for peak in peaks if peak[1] >= 0.7 * strongest)
+    # on short, noisy periods a multiple can still come out on top; it is a
+    # multiple if there are decent peaks at every fraction of it
+    def nearest_peak(lag):
+        peak = min(peaks, key=lambda peak: abs(peak[0] - lag))
+        if abs(peak[0] - lag) < lag / 8:
+            return peak
+        return None
+    for fraction in [5, 4, 3, 2]:
+        found = [nearest_peak(period * k / fraction) for k in range(1, fraction)]
+        if all(peak and peak[1] >= 0.5 * period_height for peak in found):
+            period = found[0][0]
+            break
+    # one period is only measured to a fraction of a sample; the peak a whole
+    # number of periods away pins it down that many times better. The multiple
+    # doubles each time, so the estimate never drifts by a whole period.
+    multiple = 2
+    while multiple * period < window // 2:
+        (lag, height) = min(peaks, key=lambda peak: abs(peak[0] - multiple * period))
+        if abs(lag - multiple * period) >= period / 2:
+            break
+        period = lag / multiple
+        multiple *= 2
+    return period / upsample
+
+# The stretch of decoded levels the pitch is measured from, with the mean
+# removed. Loops are repeated to fill the window, since that is how they play.
+# With a step above one, every step levels are averaged into one.
+def analysis_window(levels, looping, window, step=1):
+    if looping and 0 < len(levels) < window:
+        levels = levels * (window // len(levels) + 1)
+    levels = levels[0:window]
+    if step > 1:
+        levels = [sum(levels[i:i + step]) / step for i in range(0, len(levels) - step + 1, step)]
+    size = window // step
+    mean = sum(levels) / max(len(levels), 1)
+    centered = [level - mean for level in levels]
+    centered.extend([0.0] * (size - len(centered)))
+    return centered
+
+# The window a sample's pitch is measured over, how finely its correlation is
+# interpolated, and how many levels are averaged into each point it is computed
+# from, as (window, upsample, step).
+def analysis_size(expected_period, max_window=DEFAULT_WINDOW):
+    if not expected_period:
+        return (max_window, 1, 1)
+    # eight periods: enough to refine the estimate against, and to notice a
+    # pitch an octave low
+    window = min(max_window, max(MIN_WINDOW, next_power_of_two(int(8 * expected_period))))
+    # short periods fall between whole lags, and their peaks read low unless
+    # the correlation is interpolated
+    upsample = next_power_of_two(math.ceil(UPSAMPLED_PERIOD / expected_period))
+    upsample = max(1, min(upsample, MAX_UPSAMPLED_SIZE // (2 * window)))
+    # long periods are still resolved to a fraction of a lag with far fewer
+    # points, and the transforms shrink with them
+    step = 1
+    while expected_period / (2 * step) >= DECIMATED_PERIOD and window // (2 * step) >= MIN_WINDOW // 8:
+        step *= 2
+    return (window, upsample, step)
+
+# Measures the fundamental of every sample, in cycles per sample so that it holds
+# at any playback rate. Samples are grouped by window size and measured two per
+# transform. Each entry of samples is a dict with "levels", "looping", "length"
+# (the whole sample, in case levels only cover the window) and an
+# "expected_period" (or None), which sizes its window.
+def measure_fundamentals(samples, max_window=DEFAULT_WINDOW):
+    groups = {}
+    for index, sample in enumerate(samples):
+        groups.setdefault(analysis_size(sample["expected_period"], max_window), []).append(index)
+
+    fundamentals = [None] * len(samples)
+    for (window, upsample, step), indices in groups.items():
+        for pair_start in range(0, len(indices), 2):
+            pair = indices[pair_start:pair_start + 2]
+            signals = [analysis_window(samples[i]["levels"], samples[i]["looping"], window, step) for i in pair]
+            if len(signals) == 1:
+                signals.append([0.0] * (window // step))
+            correlations = paired_autocorrelation(signals[0], signals[1], upsample)
+            for i, correlation in zip(pair, correlations):
+                period = estimate_period(correlation, upsample)
+                if period == None:
+                    continue
+                fundamental = 1.0 / (period * step)
+                length = samples[i]["length"]
+                if samples[i]["looping"] and length > 0:
+                    # a loop can only hold a whole number of cycles, so its
+                    # spectrum only has harmonics of one cycle per loop
+                    fundamental = max(round(length * fundamental), 1) / length
+                fundamentals[i] = fundamental
+    return fundamentals
+
+def cents(frequency, reference_frequency):
+    return 1200 * math.log2(frequency / reference_frequency)
+
+# Signal to noise ratio of the decoded levels against the levels they should
+# have played, in dB, over as many levels as both have.
+def snr(target_levels, decoded_levels):
+    count = min(len(target_levels), len(decoded_levels))
+    if count == 0:
+        return None
+    target_levels = target_levels[0:count]
+    mean = sum(target_levels) / count
+    signal = 0.0
+    noise = 0.0
+    for a, b in zip(target_levels, decoded_levels):
+        signal += (a - mean) * (a - mean)
+        noise += (a - b) * (a - b)
+    if noise == 0:
+        return math.inf
+    if signal == 0:
+        return -math.inf
+    return 10 * math.log10(signal / noise)
+
+# The mapping that plays a sample at its own pitch, as opposed to the lower
+# notes fill_lower_samples pointed at it.
+def primary_mappings(note_mappings):
+    primary = {}
+    for note_mapping in note_mappings:
+        best = primary.get(note_mapping["sample_index"])
+        if best == None or (note_mapping["pitch"], note_mapping["midi_index"]) > (best["pitch"], best["midi_index"]):
+            primary[note_mapping["sample_index"]] = note_mapping
+    return primary
+
+def expected_frequency(midi_index):
+    note = midi_index - 12
+    if 0 <= note < len(midi.frequency):
+        return midi.frequency[note]
+    return None
+
+# The PCM a looper run with these generator settings would have encoded for
+# the first count samples of this sample, reconstructed from the sample's length
+# and intended note. The waveform is built from batched phase buffers, with the
+# same arithmetic as the looper's own.
+def looper_reference(generator, volume, target_bias, use_safe_amplitude):
+    def reference(note_mapping, data, count):
+        playback_rate = dpcm.playback_rate[note_mapping["pitch"]]
+        length_index = (len(data) - 1) // 16
+        target = expected_frequency(note_mapping["midi_index"])
+        repetitions = dpcm.repetitions(length_index, target, playback_rate)
+        effective_frequency = dpcm.effective_frequency(length_index, repetitions, playback_rate)
+        tuning = {"samples": min(count, len(data) * 8), "effective_frequency": effective_frequency}
+        amplitude = volume
+        if use_safe_amplitude:
+            amplitude = dpcm.safe_amplitude(effective_frequency, playback_rate) * volume
+        return looper.generate_pcm(tuning, generator, playback_rate, amplitude, target_bias, buffers={})
+    return reference
+
+# The PCM a repitcher run from this source would have encoded for the first
+# count samples of this sample.
+def repitcher_reference(source_data, source_samplerate, reference_note):
+    source_frequency = midi.frequency[midi.note_index(reference_note)]
+    def reference(note_mapping, data, count):
+        target = expected_frequency(note_mapping["midi_index"])
+        resampled = repitcher.resample_note(source_data, source_samplerate, dpcm.playback_rate[note_mapping["pitch"]], source_frequency, target)
+        return resampled[0:min(count, len(data) * 8)]
+    return reference
+
+# Verifies every mapped note of an instrument. Returns one row per mapping, in
+# note order. reference, if given, returns the PCM a sample was encoded from,
+# given its primary mapping, data and how many samples are wanted. Only as much
+# of each sample as its pitch window covers is decoded, and the SNR is taken over
+# that same stretch.
+def verify_instrument(note_mappings, samples, reference=None, max_window=DEFAULT_WINDOW):
+    primary = primary_mappings(note_mappings)
+    # every sample is decoded and measured once, however many notes play it
+    analysed = []
+    positions = {}
+    for sample_index, note_mapping in primary.items():
+        if sample_index < 1 or sample_index > len(samples) or samples[sample_index - 1] == None:
+            continue
+        data = samples[sample_index - 1]["data"]
+        target = expected_frequency(note_mapping["midi_index"])
+        expected_period = None
+        if target:
+            expected_period = dpcm.playback_rate[note_mapping["pitch"]] / target
+        (window, upsample, step) = analysis_size(expected_period, max_window)
+        count = min(window, len(data) * 8)
+        starting_level = note_mapping["delta"]
+        target_pcm = None
+        if reference:
+            target_pcm = reference(note_mapping, data, count)
+        if starting_level < 0:
+            # the counter carries over from whatever played last; assume the
+            # encoder got the start it wanted
+            starting_level = dpcm.dpcm_level(target_pcm[0]) if target_pcm else 64
+        # a short loop is decoded whole, to be repeated over the window
+        levels = dpcm.decode_levels(data[0:-(-count // 8)], starting_level)
+        positions[sample_index] = len(analysed)
+        analysed.append({
+            "levels": levels,
+            "length": len(data) * 8,
+            "looping": note_mapping["looping"],
+            "expected_period": expected_period,
+            "snr": snr([dpcm.dpcm_level(x) for x in target_pcm], levels[0:count]) if target_pcm else None,
+        })
+    fundamentals = measure_fundamentals(analysed, max_window)
+
+    rows = []
+    for note_mapping in sorted(note_mappings, key=lambda x: x["midi_index"]):
+        row = {
+            "note": midi.note_name(note_mapping["midi_index"] - 12),
+            "sample": note_mapping["sample_index"],
+            "sample_name": None,
+            "pitch": note_mapping["pitch"],
+            "repitched": primary.get(note_mapping["sample_index"]) is not note_mapping,
+            "expected": expected_frequency(note_mapping["midi_index"]),
+            "measured": None,
+            "cents": None,
+            "snr": None,
+        }
+        if note_mapping["sample_index"] in positions:
+            row["sample_name"] = samples[note_mapping["sample_index"] - 1]["name"]
+            sample = analysed[positions[note_mapping["sample_index"]]]
+            fundamental = fundamentals[positions[note_mapping["sample_index"]]]
+            row["snr"] = sample["snr"]
+            if fundamental:
+                row["measured"] = fundamental * dpcm.playback_rate[note_mapping["pitch"]]
+                if row["expected"]:
+                    row["cents"] = cents(row["measured"], row["expected"])
+        rows.append(row)
+    return rows
+
+def failures(rows, tolerance, min_snr):
+    found = []
+    for row in rows:
+        if row["sample_name"] == None:
+            found.append("{}: no sample".format(row["note"]))
+            continue
+        if row["expected"] and row["cents"] == None:
+            found.append("{}: no pitch found".format(row["note"]))
+        if row["cents"] != None and abs(row["cents"]) > tolerance:
+            found.append("{}: {:+.1f} cents".format(row["note"], row["cents"]))
+        if min_snr != None and row["snr"] != None and row["snr"] < min_snr:
+            found.append("{}: SNR {:.1f} dB".format(row["note"], row["snr"]))
+    return found
+
+def format_value(format_string, value):
+    if value == None:
+        return "-"
+    return format_string.format(value)
+
+def format_rows(rows):
+    lines = ["{:<5} {:<16} {:>4} {:>10} {:>10} {:>8} {:>8}".format("Note", "Sample", "Rate", "Expected", "Measured", "Cents", "SNR")]
+    for row in rows:
+        lines.append("{:<5} {:<16} {:>4} {:>10} {:>10} {:>8} {:>8}".format(
+            row["note"], (row["sample_name"] or "-")[0:16], "${:X}".format(row["pitch"]) + ("*" if row["repitched"] else ""),
+            format_value("{:.2f}", row["expected"]), format_value("{:.2f}", row["measured"]),
+            format_value("{:+.1f}", row["cents"]), format_value("{:.1f}", row["snr"])))
+    return "\n".join(lines)
+
+# .dmc files carry no note map, so one is made up from their names: looper
+# names samples [prefix]-[note], and --note covers anything else.
+def dmc_instrument(named_samples, note_name, pitch, looping):
+    note_mappings = []
+    samples = []
+    for (name, data) in named_samples:
+        sample_name = os.path.splitext(os.path.basename(name))[0]
+        if note_name:
+            note = midi.note_index(note_name)
+        else:
+            match = re.search(r'([A-Ga-g][BbSs#]?\d+)$', sample_name)
+            if not match:
+                raise Exception("Can't tell which note {} plays, use --note".format(name))
+            note = midi.note_index(match.group(1))
+        samples.append({"name": sample_name, "data": data})
+        note_mappings.append({"midi_index": note + 12, "sample_index": len(samples), "pitch": pitch, "looping": looping, "delta": -1})
+    return note_mappings, samples
+
+def read_inputs(args):
+    if len(args.inputs) == 1 and os.path.splitext(args.inputs[0])[1].lower() == ".fti":
+        with io.open(args.inputs[0], "rb") as instrument_file:
+            (instrument_name, note_mappings, samples) = fti.read_dpcm_instrument(instrument_file)
+        return note_mappings, samples
+    named_samples = []
+    for filename in args.inputs:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == ".fti":
+            exit("Error: verify one .fti at a time")
+        if extension in [".pack", ".zip"]:
+            with pack.ArchiveReader(filename) as archive:
+                named_samples += [(name, archive.read(name)) for name in archive.names()]
+        else:
+            with io.open(filename, "rb") as dmc_file:
+                named_samples.append((filename, dmc_file.read()))
+    return dmc_instrument(named_samples, args.note, args.quality, args.looping)
+
+def main(argv=None):
+    examples = """
+    Examples:
+      Check a looped instrument's tuning, and its SNR against the generator:
+        %(prog)s sunsaw.fti -g sawtooth
+
+      Check a repitched instrument against its source:
+        %(prog)s piano.fti --source piano.wav -r C4
+
+      Fail a CI run on anything more than 10 cents out or below 20 dB:
+        %(prog)s organ.fti -t 10 --min-snr 20
+
+      Loose .dmc files, or an archive, named [prefix]-[note]:
+        %(prog)s samples/*.dmc
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure the pitch and quality of generated DPCM instruments",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=examples)
+    parser.add_argument("inputs", nargs="+", help="One .fti instrument, or any number of .dmc files and .pack or .zip archives")
+    parser.add_argument("-t", "--tolerance", help="Largest allowed tuning error, in cents (default: 50)", type=float, default=50.0)
+    parser.add_argument("--min-snr", dest="min_snr", help="Smallest allowed SNR in dB, when there is a reference to measure it against", type=float)
+    parser.add_argument("--window", help="Most decoded samples to measure the pitch from, a power of two (default: {})".format(DEFAULT_WINDOW), type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--json", help="Write the measurements to this JSON file")
+
+    dmc_group = parser.add_argument_group("Samples Without An Instrument")
+    dmc_group.add_argument("-n", "--note", help="The note every sample plays (default: from each filename)")
+    dmc_group.add_argument("-q", "--quality", help="DPCM playback rate, ranging from 0 - 15. (default: 15)", type=int, default=15)
+    dmc_group.add_argument("--no-loop", dest="looping", help="Samples play once, rather than looping", action='store_false')
+    dmc_group.set_defaults(looping=True)
+
+    looper_group = parser.add_argument_group("Looper Reference")
+    looper_group.add_argument("-g", "--generator", metavar="GENERATOR", help="One of: {}".format(", ".join(looper.generators.keys())), choices=looper.generators)
+    looper_group.add_argument("-w", "--wavefile", help="For the wave generator")
+    looper_group.add_argument("-v", "--volume", help="As given to the looper (default: 1.0)", type=float, default=1.0)
+    looper_group.add_argument("-b", "--bias", help="As given to the looper (default: 0)", type=int, default=0)
+    looper_group.add_argument("--no-safe-volume", dest="safe_volume", help="As given to the looper", action='store_false')
+    looper_group.set_defaults(safe_volume=True)
+
+    repitcher_group = parser.add_argument_group("Repitcher Reference")
+    repitcher_group.add_argument("--source", help="The .wav the instrument was repitched from")
+    repitcher_group.add_argument("-r", "--reference", help="Reference note for the source waveform (default: C4)", default="C4")
+    args = parser.parse_args(argv)
+
+    (note_mappings, samples) = read_inputs(args)
+    reference = None
+    if args.generator:
+        generator = looper.generators[args.generator]
+        if args.generator == "wave":
+            if not args.wavefile:
+                exit("Error: wave generator requires -w, --wavefile")
+            generator = waveform.wave_file(args.wavefile)
+        reference = looper_reference(generator, args.volume, args.bias, args.safe_volume)
+    elif args.source:
+        (source_data, source_samplerate) = repitcher.read_wave(args.source)
+        reference = repitcher_reference(source_data, source_samplerate, args.reference)
+
+    rows = verify_instrument(note_mappings, samples, reference, args.window)
+    print(format_rows(rows))
+    if args.json:
+        with io.open(args.json, "w") as output:
+            # json has no infinities, and a perfect SNR is rare enough to just clamp
+            json.dump([dict(row, snr=row["snr"] if row["snr"] == None else max(-999.0, min(999.0, row["snr"]))) for row in rows], output, indent=2)
+
+    found = failures(rows, args.tolerance, args.min_snr)
+    if found:
+        exit("Failed:\n  " + "\n  ".join(found))
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()